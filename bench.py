@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+# coding: utf-8
+from __future__ import annotations
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import discord
+import fakediscord
+import bot as tobman_bot
+
+DEFAULT_SIZES = [10, 1000, 100000]
+
+def percentile(samples, ratio):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+class Benchmark:
+    def __init__(self, size, latency, events_per_channel, repeat, data_directory, storage = 'json'):
+        self.size = size
+        self.events_per_channel = events_per_channel
+        self.repeat = repeat
+        self.results = []
+        self.gateway = fakediscord.FakeGateway(latency = latency)
+        self.guild = self.gateway.add_guild(name = 'bench')
+        self.category = self.gateway.add_category(self.guild, 'Events')
+        self.users = [self.gateway.add_user() for user_index in range(200)]
+        self.gateway.install(tobman_bot.bot)
+        self.tobman = tobman_bot.bot.tobman = tobman_bot.Tobman(tobman_bot.bot)
+        if storage == 'snapshot':
+            self.tobman.storage = tobman_bot.SnapshotEventStorage(self.tobman, os.path.join(data_directory, f'bench-{size}.snapshot'))
+        else:
+            self.tobman.storage = tobman_bot.JsonEventStorage(self.tobman, os.path.join(data_directory, f'bench-{size}.json'))
+        self.tobman.events_allowed_in = [tobman_bot.Section.from_string(self.category.name)]
+        self.tobman.reaction_debouncer.window = 0.05
+        self.channels = []
+        self.event_bytes = 0
+        self.reminder_lags = []
+        self.consistency_errors = []
+    def populate(self):
+        random.seed(self.size)
+        today = datetime.date.today()
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        events = []
+        for event_index in range(self.size):
+            if event_index % self.events_per_channel == 0:
+                channel = self.gateway.add_text_channel(self.guild, category = self.category)
+                self.channels.append(channel)
+                self.tobman.events[tobman_bot.Event.format_room_id(self.guild.id, channel.id)] = []
+            event = tobman_bot.Event(f'Event {event_index}')
+            event.set_ids(self.guild.id, channel.id, self.gateway.next_id(), self.gateway.next_id())
+            event.set_date_from_string((today + datetime.timedelta(days = random.randrange(0, 120))).isoformat())
+            event.location = f'Room {event_index % 17}'
+            event.ok_user_ids = set(user.id for user in random.sample(self.users, random.randrange(0, 12)))
+            event.ng_user_ids = set(user.id for user in random.sample(self.users, random.randrange(0, 4))) - event.ok_user_ids
+            self.tobman.events[tobman_bot.Event.format_room_id(self.guild.id, channel.id)].append(event)
+            events.append(event)
+        self.event_bytes = (tracemalloc.get_traced_memory()[0] - memory_before) / max(self.size, 1)
+        tracemalloc.stop()
+        for event in events:
+            self.gateway.add_event_message(event)
+    async def measure(self, operation, function, repeat = None):
+        calls_before = self.gateway.http.calls.copy()
+        waits_before = self.gateway.http.rate_limit_waits
+        samples = []
+        for iteration in range(repeat or self.repeat):
+            started = time.perf_counter()
+            await function(iteration)
+            samples.append(time.perf_counter() - started)
+        api_calls = self.gateway.http.calls - calls_before
+        self.results.append((operation, samples, api_calls, self.gateway.http.rate_limit_waits - waits_before))
+    def season_calendar(self, iteration, event_count):
+        lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//tobman//bench//EN']
+        for event_index in range(event_count):
+            event_date = datetime.date.today() + datetime.timedelta(days = 7 * (event_index + 1))
+            lines.extend(['BEGIN:VEVENT', f'UID:bench-{iteration}-{event_index}', f'DTSTAMP:{event_date:%Y%m%d}T000000Z',
+                f'DTSTART;VALUE=DATE:{event_date:%Y%m%d}', f'SUMMARY:Match {iteration}-{event_index}', 'LOCATION:Stadium', 'END:VEVENT'])
+        lines.append('END:VCALENDAR')
+        return '\r\n'.join(lines) + '\r\n'
+    def stress_actions(self, channel, rng):
+        # commands, reactions and deletions of one channel, fired all at once with the other channels
+        room_id = tobman_bot.Event.format_room_id(self.guild.id, channel.id)
+        events = list(self.tobman.events.get(room_id) or [])
+        date_string = (datetime.date.today() + datetime.timedelta(days = 30)).isoformat()
+        new_command = tobman_bot.bot.get_command('event.new').callback
+        edit_command = tobman_bot.bot.get_command('event.edit').callback
+        delete_command = tobman_bot.bot.get_command('event.delete').callback
+        async def react(event, user, emoji, add):
+            message = channel.messages.get(event.message_id)
+            if add:
+                if message is not None:
+                    message.react(user, emoji)
+                await self.tobman.on_event_reaction_add(self.guild.id, channel.id, event.message_id, user.id, discord.PartialEmoji(name = emoji))
+            else:
+                if message is not None:
+                    message.unreact(user, emoji)
+                await self.tobman.on_event_reaction_remove(self.guild.id, channel.id, event.message_id, user.id, discord.PartialEmoji(name = emoji))
+        async def user_delete(event):
+            channel.messages.pop(event.message_id, None)
+            await self.tobman.on_event_message_delete(self.guild.id, channel.id, event.message_id)
+        actions = [new_command(self.context(channel), f'Stress {channel.id} {index}', f'date:{date_string}') for index in range(3)]
+        actions += [edit_command(self.context(channel), rng.choice(events).title, f'loc:Room {index}') for index in range(2)]
+        actions += [delete_command(self.context(channel), rng.choice(events).title)]
+        actions += [user_delete(event) for event in rng.sample(events, min(2, len(events)))]
+        actions += [react(rng.choice(events), rng.choice(self.users), rng.choice(tobman_bot.Event.REACTIONS), rng.random() < 0.7) for index in range(20)]
+        actions += [self.tobman.refresh_channel_events(channel)]
+        rng.shuffle(actions)
+        return actions
+    def check_consistency(self, channel):
+        room_id = tobman_bot.Event.format_room_id(self.guild.id, channel.id)
+        event_list = self.tobman.events.get(room_id) or []
+        errors = []
+        if len(set(event.message_id for event in event_list)) != len(event_list):
+            errors.append(f'{room_id}: duplicate events')
+        for event in event_list:
+            message = channel.messages.get(event.message_id)
+            if self.tobman.events_by_message_id.get(event.message_id) is not event:
+                errors.append(f'{room_id}: {event.title} missing from events_by_message_id')
+            if event not in self.tobman.title_index.find(self.guild.id, channel.id, event.title):
+                errors.append(f'{room_id}: {event.title} missing from the title index')
+            if message is None:
+                errors.append(f'{room_id}: {event.title} kept although its message was deleted')
+                continue
+            for emoji, roster in [(tobman_bot.Event.REACTION_OK, event.ok_user_ids), (tobman_bot.Event.REACTION_NG, event.ng_user_ids)]:
+                reaction = message.get_reaction(emoji)
+                user_ids = set(user.id for user in (reaction.user_list if reaction else []) if user != self.gateway.user)
+                if roster != user_ids:
+                    errors.append(f'{room_id}: {event.title} {emoji} roster {sorted(roster or [])} != reactions {sorted(user_ids)}')
+        for event in self.tobman.events_by_message_id.values():
+            if (event.channel_id == channel.id) and (event not in event_list):
+                errors.append(f'{room_id}: {event.title} indexed but not listed')
+        return errors
+    def context(self, channel):
+        return fakediscord.FakeContext(channel, self.guild.get_member(random.choice(self.users).id))
+    async def run(self):
+        self.populate()
+        async def save_data(iteration):
+            self.tobman.storage.write_data(self.tobman.storage.snapshot_data())
+        await self.measure('save_data', save_data, repeat = 3)
+        async def load_data(iteration):
+            self.tobman.events = {}
+            self.tobman.events_by_message_id = {}
+            self.tobman.loaded_guilds = set()
+            self.tobman.load_data()
+            self.tobman.load_guild(self.guild.id)
+        await self.measure('load_data', load_data, repeat = 3)
+        def miss_offline_changes():
+            # reactions and deletions that happened while the bot was offline
+            events = list(self.tobman.events_by_message_id.values())
+            for event in random.sample(events, len(events) // 20):
+                message = self.gateway.channels[event.channel_id].messages[event.message_id]
+                message.react(random.choice(self.users), random.choice(tobman_bot.Event.REACTIONS))
+            for event in random.sample(events, len(events) // 100):
+                self.gateway.channels[event.channel_id].messages.pop(event.message_id, None)
+        async def reconcile(iteration):
+            miss_offline_changes()
+            await self.tobman.reconcile_events()
+        await self.measure('reconcile_events', reconcile, repeat = 1)
+        self.tobman.storage.start()
+        channel = self.channels[0]
+        new_command = tobman_bot.bot.get_command('event.new').callback
+        async def event_new(iteration):
+            date_string = (datetime.date.today() + datetime.timedelta(days = 30)).isoformat()
+            await new_command(self.context(channel), f'New event {iteration}', f'date:{date_string}', 'loc:Bench')
+        await self.measure('event.new', event_new)
+        import_command = tobman_bot.bot.get_command('event.import').callback
+        async def event_import(iteration):
+            attachment = fakediscord.FakeAttachment('season.ics', self.season_calendar(iteration, 20).encode('utf-8'))
+            await import_command(fakediscord.FakeContext(channel, self.guild.get_member(random.choice(self.users).id), attachments = [attachment]))
+        await self.measure('event.import (20)', event_import, repeat = 1)
+        list_command = tobman_bot.bot.get_command('event.list').callback
+        async def event_list(iteration):
+            await list_command(self.context(channel))
+        await self.measure('event.list', event_list)
+        async def background_refresh(iteration):
+            await asyncio.gather(*self.tobman.refresh_tasks.values())
+        await self.measure('event.list refresh', background_refresh, repeat = 1)
+        async def title_autocomplete(iteration):
+            title = random.choice(self.tobman.events[tobman_bot.Event.format_room_id(self.guild.id, channel.id)]).title
+            typed = title[:random.randrange(1, len(title) + 1)]
+            if iteration % 2:
+                # a typo: two letters swapped
+                position = random.randrange(len(title) - 1)
+                typed = title[:position] + title[position + 1] + title[position] + title[position + 2:]
+            self.tobman.title_index.suggest(self.guild.id, channel.id, typed)
+        await self.measure('title autocomplete', title_autocomplete, repeat = self.repeat * 10)
+        edit_command = tobman_bot.bot.get_command('event.edit').callback
+        async def event_edit(iteration):
+            event_list = self.tobman.events[tobman_bot.Event.format_room_id(self.guild.id, channel.id)]
+            event = event_list[iteration % len(event_list)]
+            await edit_command(self.context(channel), event.title, f'loc:Room {iteration}')
+            await self.tobman.notifications.drain()
+        await self.measure('event.edit', event_edit)
+        async def reaction_burst(iteration):
+            event = self.tobman.events[tobman_bot.Event.format_room_id(self.guild.id, channel.id)][iteration]
+            message = channel.messages[event.message_id]
+            for user in self.users[:30]:
+                message.react(user, tobman_bot.Event.REACTION_OK)
+                await self.tobman.on_event_reaction_add(self.guild.id, channel.id, event.message_id, user.id, discord.PartialEmoji(name = tobman_bot.Event.REACTION_OK))
+            pending = self.tobman.reaction_debouncer.pending.get(event.message_id)
+            if pending is not None:
+                await pending.task
+            await self.tobman.notifications.drain()
+        await self.measure('reaction burst (30)', reaction_burst)
+        stress_channels = self.channels[:10]
+        async def stress(iteration):
+            rng = random.Random(iteration)
+            actions = [action for stress_channel in stress_channels for action in self.stress_actions(stress_channel, rng)]
+            rng.shuffle(actions)
+            results = await asyncio.gather(*actions, return_exceptions = True)
+            self.consistency_errors += [f'{type(result).__name__}: {result}' for result in results if isinstance(result, BaseException)]
+            while self.tobman.reaction_debouncer.pending:
+                await asyncio.gather(*[pending.task for pending in list(self.tobman.reaction_debouncer.pending.values())])
+            await self.tobman.notifications.drain()
+            for stress_channel in stress_channels:
+                self.consistency_errors += self.check_consistency(stress_channel)
+        await self.measure(f'stress ({len(stress_channels)} channels)', stress, repeat = 1)
+        async def scheduled_job(iteration):
+            reminder_days = [days_remaining for days_remaining, event_date_message in self.tobman.EVENT_DAYS]
+            due_reminders = [(event, event.remaining_days()) for event in self.tobman.events_by_message_id.values() if event.remaining_days() in reminder_days]
+            duration, channel_lags = await self.tobman.events_scheduled_job(due_reminders)
+            self.reminder_lags = sorted(channel_lags.values())
+            await self.tobman.notifications.drain()
+        await self.measure('events_scheduled_job', scheduled_job, repeat = 1)
+        await self.tobman.shutdown()
+    def report(self, output):
+        print(f'\n== {self.size} event(s), {len(self.channels)} channel(s), {self.event_bytes:.0f} bytes per event ==', file = output)
+        print(f'{"operation":<24}{"runs":>6}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"429s":>6}  api calls', file = output)
+        for operation, samples, api_calls, rate_limit_waits in self.results:
+            calls = ', '.join(f'{route}={count}' for route, count in sorted(api_calls.items())) or '-'
+            print(f'{operation:<24}{len(samples):>6}{percentile(samples, 0.5) * 1000:>10.1f}{percentile(samples, 0.95) * 1000:>10.1f}{percentile(samples, 0.99) * 1000:>10.1f}{rate_limit_waits:>6}  {calls}', file = output)
+        if self.reminder_lags:
+            print(f'{"reminder channel lag":<24}{len(self.reminder_lags):>6}{percentile(self.reminder_lags, 0.5) * 1000:>10.1f}{percentile(self.reminder_lags, 0.95) * 1000:>10.1f}{percentile(self.reminder_lags, 0.99) * 1000:>10.1f}', file = output)
+        print(f'consistency errors after the stress run: {len(self.consistency_errors)}', file = output)
+        for error in self.consistency_errors[:10]:
+            print(f'  {error}', file = output)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark Tobman against an in-process fake Discord')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = DEFAULT_SIZES, help = 'numbers of stored events to benchmark with')
+    parser.add_argument('--latency', type = float, default = 0.01, help = 'simulated Discord API latency in seconds')
+    parser.add_argument('--events-per-channel', type = int, default = 50)
+    parser.add_argument('--repeat', type = int, default = 10, help = 'runs of each command')
+    parser.add_argument('--storage', choices = ['json', 'snapshot'], default = 'json', help = 'event data format to save and load')
+    args = parser.parse_args(argv)
+    consistent = True
+    with tempfile.TemporaryDirectory() as data_directory:
+        for size in args.sizes:
+            benchmark = Benchmark(size, args.latency, args.events_per_channel, args.repeat, data_directory, args.storage)
+            # the bot logs every command and reminder, keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(benchmark.run())
+            benchmark.report(sys.stdout)
+            consistent = consistent and (len(benchmark.consistency_errors) == 0)
+    print(f'\npeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+    return 0 if consistent else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,7 +2,9 @@
 # coding: utf-8
 from __future__ import annotations
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
+from discord import app_commands
+from aiohttp import web
 from enum import Enum
 import yaml
 import re
@@ -14,6 +16,19 @@ import datetime
 import ics
 import io
 import asyncio
+import argparse
+import collections
+import bisect
+import contextlib
+import subprocess
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import mmap
+import struct
+import sqlite3
+import time
 
 class Translation:
     UNABLE_RENAME_USER='Impossible de renommer l\'utilisateur {0}'
@@ -25,6 +40,7 @@ class Translation:
     EVENTS_LIST_TITLE='Événements sur #{0}'
     EVENTS_LIST_NONE='Aucun événement sur #{0}'
     EVENTS_LIST_DESC='{1} événement(s) sur #{0}'
+    EVENTS_LIST_PAGE='Page {0}/{1}'
     EVENTS_CLEAR_TITLE='Purge des événements sur #{0}'
     EVENTS_CLEAR_DESC='{0} événement(s) supprimé(s)'
     EVENTS_DELETE_TITLE='Suppression de l\'événement'
@@ -35,6 +51,8 @@ class Translation:
     EVENTS_REACT_TITLE='Événement **{0}**'
     EVENTS_REACT_OK='{0} participe à l\'événement [{1}]({2})'
     EVENTS_REACT_NG='{0} ne participe pas à l\'événement [{1}]({2})'
+    EVENTS_REACT_OK_PLURAL='{0} participent à l\'événement [{1}]({2})'
+    EVENTS_REACT_NG_PLURAL='{0} ne participent pas à l\'événement [{1}]({2})'
     EVENTS_INFO_ADDED_BY='Ajouté par'
     EVENTS_INFO_REMAINING_DAYS='dans {0} jours'
     EVENTS_INFO_REMAINING_DAYS_TODAY='aujourd\'hui'
@@ -46,6 +64,9 @@ class Translation:
     EVENTS_EDIT_DESC='Événement [{0}]({1}) modifié'
     EVENTS_EDIT_BY='Par'
     EVENTS_EDIT_NONE='Aucun événement ne correspond à **{0}**'
+    EVENTS_SUGGESTIONS='Vouliez-vous dire'
+    EVENTS_EDIT_COMMAND='Modifier un événement'
+    EVENTS_DELETE_COMMAND='Supprimer un événement'
     EVENTS_MODIFICATION='Modification'
     EVENTS_MODIFICATION_DATE='Date *{0}* ➡️ *{1}*'
     EVENTS_MODIFICATION_LOC='Lieu *{0}* ➡️ *{1}*'
@@ -53,9 +74,19 @@ class Translation:
     EVENTS_MODIFICATION_TITLE='Titre *{0}* ➡️ *{1}*'
     EVENTS_REMINDER_TITLE='ℹ Événements à venir'
     EVENT_CALENDAR_FILENAME='Agenda - {0}.ics'
+    CONFIG_RELOAD_TITLE='Configuration'
+    CONFIG_RELOAD_DONE='Configuration rechargée'
+    CONFIG_RELOAD_ERROR='Configuration invalide, la configuration actuelle est conservée'
+    EVENTS_IMPORT_TITLE='Import d\'événements'
+    EVENTS_IMPORT_DESC='{0} événement(s) importé(s) sur #{1}'
+    EVENTS_IMPORT_NONE='Aucun fichier .ics joint à la commande'
+    EVENTS_IMPORT_ERROR='Impossible de lire le fichier **{0}**'
 
 CONFIG_FILENAME='tobman.yaml'
 DATA_JSON_FILENAME='tobman-data.json'
+DATA_JOURNAL_FILENAME='tobman-data.journal'
+DATA_SQLITE_FILENAME='tobman-data.sqlite3'
+DATA_SNAPSHOT_FILENAME='tobman-data.snapshot'
 
 class SectionType(Enum):
     TEXT_CHANNEL = 1
@@ -85,6 +116,34 @@ class Section:
                 return True
         return False
 
+class SectionPermissions:
+    RENAME = 'rename'
+    EVENTS = 'events'
+    def __init__(self, tobman):
+        self.tobman = tobman
+        # channel id -> frozenset of the permissions allowed in the channel
+        self.allowed = {}
+    def resolve(self, channel):
+        allowed = self.allowed.get(channel.id)
+        if allowed is None:
+            allowed = set()
+            if Section.list_fits(self.tobman.rename_allowed_in, channel):
+                allowed.add(self.RENAME)
+            if Section.list_fits(self.tobman.events_allowed_in, channel):
+                allowed.add(self.EVENTS)
+            allowed = self.allowed[channel.id] = frozenset(allowed)
+        return allowed
+    def allows(self, channel, permission):
+        return permission in self.resolve(channel)
+    def invalidate(self, channel):
+        self.allowed.pop(channel.id, None)
+        # channels in a category match category sections by the category name
+        if isinstance(channel, discord.CategoryChannel):
+            for child_channel in channel.channels:
+                self.allowed.pop(child_channel.id, None)
+    def clear(self):
+        self.allowed = {}
+
 class EventError(Enum):
     DATE_ERROR = 1
 
@@ -108,19 +167,28 @@ class Event:
     DATE_PREFIX='date:'
     URL_PREFIX='url:'
     LOCATION_PREFIX='loc:'
+    # the discord.Message is not kept, only what rendering the event needs
+    __slots__ = ('guild_id', 'channel_id', 'message_id', 'command_message_id', 'title', 'url_string', 'url_thumbnail', 'description',
+        'location', 'date', 'original_user_id', 'ok_user_ids', 'ng_user_ids', 'embed_digest', 'ok_count', 'ng_count', 'refreshed_at')
     def __init__(self, title):
         self.guild_id = None
         self.channel_id = None
         self.message_id = None
         self.command_message_id = None
         self.title = title
-        self.message = None
         self.url_string = None
         self.url_thumbnail = None
         self.description = ''
         self.location = ''
         self.date = None
         self.original_user_id = None
+        self.ok_user_ids = None
+        self.ng_user_ids = None
+        self.embed_digest = None
+        # reaction counts and time of the last fetched message
+        self.ok_count = None
+        self.ng_count = None
+        self.refreshed_at = None
     @classmethod
     def parse_new_command(cls, original_message, args_list):
         event = None
@@ -147,6 +215,18 @@ class Event:
             elif original_embed and original_embed.image and original_embed.image.url.startswith('http'):
                 event.url_thumbnail = original_embed.image.url
         return event, None
+    def from_ics_calendar(ics_text):
+        events = []
+        ics_events = [ics_event for ics_event in ics.Calendar(ics_text).events if ics_event.begin and ics_event.name]
+        for ics_event in sorted(ics_events, key = lambda ics_event: ics_event.begin):
+            event = Event(str(ics_event.name))
+            event.date = datetime.datetime.combine(ics_event.begin.date(), datetime.time(hour=11, minute=59))
+            event.description = ics_event.description or ''
+            event.location = ics_event.location or ''
+            if ics_event.url:
+                event.set_url(ics_event.url)
+            events.append(event)
+        return events
     def parse_edit_command(self, arg_list):
         for arg in arg_list:
             for function in [self.parse_title, self.parse_date, self.parse_loc, self.parse_url]:
@@ -198,22 +278,62 @@ class Event:
         self.channel_id = channel_id
         self.message_id = message_id
         self.command_message_id = command_message_id
-    def user_counts(self):
-        ok_count = None
-        ng_count = None
-        if self.message is not None:
-            ok_count = 0
-            ng_count = 0
-            for reaction in self.message.reactions:
-                if reaction.emoji == self.REACTION_OK:
-                    ok_count = reaction.count
-                    if reaction.me:
-                        ok_count -= 1
-                elif reaction.emoji == self.REACTION_NG:
-                    ng_count = reaction.count
-                    if reaction.me:
-                        ng_count -= 1
+    def reaction_counts(message):
+        ok_count = 0
+        ng_count = 0
+        for reaction in message.reactions:
+            if reaction.emoji == Event.REACTION_OK:
+                ok_count = reaction.count
+                if reaction.me:
+                    ok_count -= 1
+            elif reaction.emoji == Event.REACTION_NG:
+                ng_count = reaction.count
+                if reaction.me:
+                    ng_count -= 1
         return ok_count, ng_count
+    def user_counts(self):
+        if self.has_roster():
+            return len(self.ok_user_ids), len(self.ng_user_ids)
+        return self.ok_count, self.ng_count
+    def has_counts(self):
+        return self.has_roster() or (self.ok_count is not None)
+    def has_roster(self):
+        return (self.ok_user_ids is not None) and (self.ng_user_ids is not None)
+    def roster_matches(self, message):
+        return self.has_roster() and Event.reaction_counts(message) == (len(self.ok_user_ids), len(self.ng_user_ids))
+    def roster_for(self, emoji_name):
+        if emoji_name == self.REACTION_OK:
+            return self.ok_user_ids
+        if emoji_name == self.REACTION_NG:
+            return self.ng_user_ids
+        return None
+    def roster_add(self, emoji_name, user_id):
+        roster = self.roster_for(emoji_name)
+        if (roster is not None) and (user_id not in roster):
+            roster.add(user_id)
+            return True
+        return False
+    def roster_remove(self, emoji_name, user_id):
+        roster = self.roster_for(emoji_name)
+        if (roster is not None) and (user_id in roster):
+            roster.remove(user_id)
+            return True
+        return False
+    async def build_roster(self, message):
+        ok_user_ids = set()
+        ng_user_ids = set()
+        for reaction in message.reactions:
+            if reaction.emoji == self.REACTION_OK:
+                roster = ok_user_ids
+            elif reaction.emoji == self.REACTION_NG:
+                roster = ng_user_ids
+            else:
+                continue
+            async for user in reaction.users():
+                if user != bot.user:
+                    roster.add(user.id)
+        self.ok_user_ids = ok_user_ids
+        self.ng_user_ids = ng_user_ids
     def message_url(self):
         return f'https://discordapp.com/channels/{self.guild_id}/{self.channel_id}/{self.message_id}'
     def summary(self):
@@ -226,7 +346,7 @@ class Event:
                 remaining_days_string = f' *{Translation.EVENTS_INFO_REMAINING_DAYS_TOMORROW}*'
             elif remaining_days == 0:
                 remaining_days_string = f' *{Translation.EVENTS_INFO_REMAINING_DAYS_TODAY}*'
-        if self.message is not None:
+        if self.has_counts():
             ok_count, ng_count = self.user_counts()
             url_part = ''
             if self.url_string:
@@ -252,6 +372,11 @@ class Event:
             serializable['th'] = self.url_thumbnail
         if self.original_user_id:
             serializable['ouid'] = self.original_user_id
+        if self.has_roster():
+            serializable['ok'] = sorted(self.ok_user_ids)
+            serializable['ng'] = sorted(self.ng_user_ids)
+        if self.embed_digest:
+            serializable['ed'] = self.embed_digest
         return serializable
     def from_deserializable(deserializable):
         try:
@@ -274,6 +399,11 @@ class Event:
                     event.location = str(deserializable['loc'])
                 if 'ouid' in deserializable:
                     event.original_user_id = int(deserializable['ouid'])
+                if ('ok' in deserializable) and ('ng' in deserializable):
+                    event.ok_user_ids = set(int(user_id) for user_id in deserializable['ok'])
+                    event.ng_user_ids = set(int(user_id) for user_id in deserializable['ng'])
+                if 'ed' in deserializable:
+                    event.embed_digest = str(deserializable['ed'])
                 return event
         except Exception as err:
             print(f'Error deserializing event: {json.dump(deserializable)}: {err}', file=sys.stderr)
@@ -289,19 +419,39 @@ class Event:
         if self.date:
             return self.date.strftime(self.DATE_FORMAT)
         return None
+    def generate_ics_event(self):
+        cal_event = ics.Event()
+        cal_event.name = self.title
+        cal_event.begin = self.date
+        cal_event.created = datetime.datetime.today()
+        cal_event.description = self.description
+        cal_event.location = self.location
+        if self.url_string:
+            cal_event.url = self.url_string
+        if self.message_id:
+            # keep the same uid across feed rebuilds so calendar clients update the event in place
+            cal_event.uid = f'{self.message_id}@tobman'
+        cal_event.make_all_day()
+        return cal_event
+    def ics_key(self):
+        return (self.title, self.get_date_string(), self.description, self.location, self.url_string)
+    def generate_ics_lines(self):
+        cal = ics.Calendar()
+        cal.events.add(self.generate_ics_event())
+        lines = []
+        in_event = False
+        for line in ''.join(cal).splitlines():
+            if line == 'BEGIN:VEVENT':
+                in_event = True
+            if in_event:
+                lines.append(line)
+            if line == 'END:VEVENT':
+                in_event = False
+        return lines
     def generate_date_ics(self):
         if self.date:
             cal = ics.Calendar()
-            cal_event = ics.Event()
-            cal_event.name = self.title
-            cal_event.begin = self.date
-            cal_event.created = datetime.datetime.today()
-            cal_event.description = self.description
-            cal_event.location = self.location
-            if self.url_string:
-                cal_event.url = self.url_string
-            cal_event.make_all_day()
-            cal.events.add(cal_event)
+            cal.events.add(self.generate_ics_event())
             ics_memory_buffer = io.StringIO()
             ics_memory_buffer.writelines(cal)
             ics_memory_buffer.seek(0, 0)
@@ -330,41 +480,52 @@ class Event:
             embed.url = self.url_string
         if self.location != '':
             embed.add_field(name = Translation.EVENTS_INFO_LOCATION, value = self.location)
-        if self.message:
+        if self.has_counts():
             await self.generate_add_ok_ng_embed_fields(embed)
         if self.url_thumbnail:
             embed.set_thumbnail(url = self.url_thumbnail)
         return embed
-    async def ok_users(self):
-        users = []
-        for reaction in self.message.reactions:
-            if reaction.emoji == self.REACTION_OK:
-                async for user in reaction.users():
-                    if user != bot.user:
-                        users.append(user)
-        return users
-    async def ng_users(self):
-        users = []
-        for reaction in self.message.reactions:
-            if reaction.emoji == self.REACTION_NG:
-                async for user in reaction.users():
-                    if user != bot.user:
-                        users.append(user)
-        return users
+    def ok_mentions(self):
+        return [f'<@{user_id}>' for user_id in sorted(self.ok_user_ids or ())]
+    def ng_mentions(self):
+        return [f'<@{user_id}>' for user_id in sorted(self.ng_user_ids or ())]
     async def generate_add_ok_ng_embed_fields(self, embed):
+        if not self.has_roster():
+            return
         ok_count, ng_count = self.user_counts()
         if (ok_count and (ok_count > 0)) or (ng_count and (ng_count > 0)):
-            ok_mentions = [user.mention for user in await self.ok_users()]
-            ng_mentions = [user.mention for user in await self.ng_users()]
             if ok_count > 0:
-                embed.add_field(name = Translation.EVENTS_INFO_LIST_STATUS.format(self.REACTION_OK, ok_count), value = '\n'.join(ok_mentions))
+                embed.add_field(name = Translation.EVENTS_INFO_LIST_STATUS.format(self.REACTION_OK, ok_count), value = '\n'.join(self.ok_mentions()))
             if ng_count > 0:
-                embed.add_field(name = Translation.EVENTS_INFO_LIST_STATUS.format(self.REACTION_OK, ng_count), value = '\n'.join(ng_mentions))
+                embed.add_field(name = Translation.EVENTS_INFO_LIST_STATUS.format(self.REACTION_NG, ng_count), value = '\n'.join(self.ng_mentions()))
     async def set_message(self, message):
-        self.message = message
-        # Edit the message
+        self.ok_count, self.ng_count = Event.reaction_counts(message)
+        self.refreshed_at = time.time()
+        # the roster is only rebuilt from the reactions when it drifted from the reaction counts
+        if not self.roster_matches(message):
+            await self.build_roster(message)
+            bot.tobman.update_event(self)
+        # Edit the message, unless it already shows the same embed
         embed = await self.generate_discord_embed()
-        await message.edit(embed = embed)
+        embed_digest = Event.digest_embed(embed)
+        if self.embed_digest is not None:
+            unchanged = (embed_digest == self.embed_digest)
+        else:
+            unchanged = (len(message.embeds) > 0) and (Event.embed_signature(message.embeds[0]) == Event.embed_signature(embed))
+        if unchanged:
+            bot.tobman.metrics.inc(Metrics.MESSAGE_EDITS, result = 'skipped')
+        else:
+            await bot.tobman.rate_limiter.acquire(RateLimiter.EDIT_MESSAGE, self.channel_id)
+            await message.edit(embed = embed)
+            bot.tobman.metrics.inc(Metrics.MESSAGE_EDITS, result = 'issued')
+        if embed_digest != self.embed_digest:
+            self.embed_digest = embed_digest
+            bot.tobman.update_event(self)
+    def digest_embed(embed):
+        return hashlib.sha1(json.dumps(embed.to_dict(), sort_keys = True).encode('utf-8')).hexdigest()
+    def embed_signature(embed):
+        fields = tuple((field.name, field.value, field.inline) for field in embed.fields)
+        return (embed.title, embed.description or '', embed.url, fields, getattr(embed.thumbnail, 'url', None))
     def today(self):
         return datetime.datetime.combine(datetime.datetime.today(), datetime.time(hour = self.date.hour, minute = self.date.minute, second = self.date.second, microsecond = self.date.microsecond, tzinfo = self.date.tzinfo))
     def still_active(self):
@@ -380,175 +541,1658 @@ class Event:
             delta = self.date - today
             return int(delta.days)
         return None
+    async def fetch_message(self, discord_messageable):
+        await bot.tobman.rate_limiter.acquire(RateLimiter.FETCH_MESSAGE, self.channel_id)
+        return await discord_messageable.fetch_message(int(self.message_id))
     async def refresh_message(self, discord_messageable):
-        message = await discord_messageable.fetch_message(int(self.message_id))
+        message = await self.fetch_message(discord_messageable)
         if message:
             await self.set_message(message)
             return message
         return None
 
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last count is for the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    COMMAND_DURATION = 'tobman_command_duration_seconds'
+    HANDLER_DURATION = 'tobman_handler_duration_seconds'
+    API_CALLS = 'tobman_discord_api_calls_total'
+    RATE_LIMIT_WAITS = 'tobman_rate_limit_waits_total'
+    RATE_LIMIT_WAIT_SECONDS = 'tobman_rate_limit_wait_seconds_total'
+    SAVE_DURATION = 'tobman_save_duration_seconds'
+    SAVE_BYTES = 'tobman_save_bytes'
+    SCHEDULER_LAG = 'tobman_scheduler_lag_seconds'
+    NOTIFICATION_QUEUE_DEPTH = 'tobman_notification_queue_depth'
+    NOTIFICATION_LATENCY = 'tobman_notification_latency_seconds'
+    NOTIFICATION_MESSAGES = 'tobman_notification_messages_total'
+    REMINDER_DISPATCH = 'tobman_reminder_dispatch_seconds'
+    REMINDER_CHANNEL_LAG = 'tobman_reminder_channel_lag_seconds'
+    MESSAGE_EDITS = 'tobman_message_edits_total'
+    # name -> (type, help)
+    DESCRIPTIONS = {
+        COMMAND_DURATION: ('histogram', 'Time spent running a bot command'),
+        HANDLER_DURATION: ('histogram', 'Time spent in a raw gateway event handler'),
+        API_CALLS: ('counter', 'Discord API requests by call'),
+        RATE_LIMIT_WAITS: ('counter', 'Requests delayed by the client side rate limiter'),
+        RATE_LIMIT_WAIT_SECONDS: ('counter', 'Time spent waiting on the client side rate limiter'),
+        SAVE_DURATION: ('histogram', 'Time spent persisting the event data'),
+        SAVE_BYTES: ('gauge', 'Size of the event data after the last save'),
+        SCHEDULER_LAG: ('histogram', 'Delay between the planned and the actual time of a reminder'),
+        NOTIFICATION_QUEUE_DEPTH: ('gauge', 'Notification embeds waiting to be sent'),
+        NOTIFICATION_LATENCY: ('histogram', 'Time between queuing a notification and sending it'),
+        NOTIFICATION_MESSAGES: ('counter', 'Messages sent by the notification queue, by number of packed embeds'),
+        REMINDER_DISPATCH: ('histogram', 'Time to send the reminders due at once to all channels'),
+        REMINDER_CHANNEL_LAG: ('histogram', 'Time between the start of a reminder dispatch and the reminder of a channel being sent'),
+        MESSAGE_EDITS: ('counter', 'Event message refreshes, issued as an edit or skipped because the embed did not change'),
+    }
+    # (method, discord.py route path) -> call name
+    API_ROUTES = {
+        ('GET', '/channels/{channel_id}/messages'): 'history',
+        ('POST', '/channels/{channel_id}/messages'): 'send_message',
+        ('GET', '/channels/{channel_id}/messages/{message_id}'): 'fetch_message',
+        ('PATCH', '/channels/{channel_id}/messages/{message_id}'): 'edit_message',
+        ('DELETE', '/channels/{channel_id}/messages/{message_id}'): 'delete_message',
+        ('GET', '/channels/{channel_id}/messages/{message_id}/reactions/{emoji}'): 'reaction_users',
+        ('PUT', '/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me'): 'add_reaction',
+    }
+    def __init__(self):
+        # name -> {sorted label items -> value or Histogram}
+        self.samples = { name: {} for name in self.DESCRIPTIONS }
+    def labels_key(labels):
+        return tuple(sorted(labels.items()))
+    def inc(self, name, amount = 1, **labels):
+        samples = self.samples[name]
+        key = Metrics.labels_key(labels)
+        samples[key] = samples.get(key, 0) + amount
+    def set(self, name, value, **labels):
+        self.samples[name][Metrics.labels_key(labels)] = value
+    def observe(self, name, value, **labels):
+        samples = self.samples[name]
+        key = Metrics.labels_key(labels)
+        histogram = samples.get(key)
+        if histogram is None:
+            histogram = samples[key] = Histogram()
+        histogram.observe(value)
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    def count_api_call(self, call):
+        self.inc(self.API_CALLS, call = call)
+    def instrument_http(self, http):
+        request = http.request
+        async def counted_request(route, *args, **kwargs):
+            self.count_api_call(self.API_ROUTES.get((route.method, route.path), f'{route.method} {route.path}'))
+            return await request(route, *args, **kwargs)
+        http.request = counted_request
+    def format_labels(label_items):
+        if len(label_items) == 0:
+            return ''
+        escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in label_items]
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+    def format_value(value):
+        return repr(float(value)) if isinstance(value, float) else str(value)
+    def render(self):
+        lines = []
+        for name, (metric_type, help_text) in self.DESCRIPTIONS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for key, value in sorted(self.samples[name].items()):
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(list(value.buckets) + ['+Inf'], value.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{Metrics.format_labels(key + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{Metrics.format_labels(key)} {Metrics.format_value(value.sum)}')
+                    lines.append(f'{name}_count{Metrics.format_labels(key)} {value.count}')
+                else:
+                    lines.append(f'{name}{Metrics.format_labels(key)} {Metrics.format_value(value)}')
+        return '\n'.join(lines) + '\n'
+    async def handle_request(self, request):
+        return web.Response(text = self.render(), content_type = 'text/plain', charset = 'utf-8', headers = { 'Cache-Control': 'no-cache' })
+
+class RateLimiter:
+    FETCH_MESSAGE = 'fetch_message'
+    EDIT_MESSAGE = 'edit_message'
+    SEND_MESSAGE = 'send_message'
+    ADD_REACTION = 'add_reaction'
+    DELETE_MESSAGE = 'delete_message'
+    # (requests, per seconds) for each route, counted per channel like the Discord buckets
+    ROUTE_LIMITS = {
+        FETCH_MESSAGE: (50, 1.0),
+        EDIT_MESSAGE: (5, 5.0),
+        SEND_MESSAGE: (5, 5.0),
+        ADD_REACTION: (1, 0.25),
+        DELETE_MESSAGE: (5, 1.0),
+    }
+    # Discord counts fixed windows that open with the first request, the window kept here opens a bit
+    # earlier than the server's one, so nothing is sent until the server's window surely closed
+    WINDOW_MARGIN = 0.05
+    def __init__(self, metrics = None, route_limits = ROUTE_LIMITS):
+        self.metrics = metrics
+        self.route_limits = dict(route_limits)
+        # (route, major id) -> (window start, requests sent in the window)
+        self.buckets = {}
+        self.wait_seconds = 0.0
+    async def acquire(self, route, major_id):
+        requests, per = self.route_limits[route]
+        key = (route, major_id)
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            window_start, count = self.buckets.get(key, (now, 0))
+            if now - window_start >= per + RateLimiter.WINDOW_MARGIN:
+                window_start, count = now, 0
+            if (count < requests) and (now - window_start < per):
+                self.buckets[key] = (window_start, count + 1)
+                self.wait_seconds += waited
+                if (waited > 0) and (self.metrics is not None):
+                    self.metrics.inc(Metrics.RATE_LIMIT_WAITS, route = route)
+                    self.metrics.inc(Metrics.RATE_LIMIT_WAIT_SECONDS, waited, route = route)
+                return waited
+            delay = window_start + per + RateLimiter.WINDOW_MARGIN - now
+            await asyncio.sleep(delay)
+            waited += delay
+
+class NotificationQueue:
+    # Discord accepts up to 10 embeds and 6000 embed characters in a message
+    MAX_EMBEDS = 10
+    MAX_EMBED_CHARACTERS = 6000
+    def __init__(self, tobman):
+        self.tobman = tobman
+        # channel id -> deque of (embed, time queued)
+        self.pending = {}
+        # channel id -> task sending the pending embeds of the channel
+        self.tasks = {}
+        self.depth = 0
+    def notify(self, channel, embed):
+        self.pending.setdefault(channel.id, collections.deque()).append((embed, time.perf_counter()))
+        self.set_depth(self.depth + 1)
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self.send_pending(channel))
+    def set_depth(self, depth):
+        self.depth = depth
+        self.tobman.metrics.set(Metrics.NOTIFICATION_QUEUE_DEPTH, depth)
+    def next_batch(pending):
+        batch = []
+        characters = 0
+        while pending and (len(batch) < NotificationQueue.MAX_EMBEDS):
+            embed_characters = len(pending[0][0])
+            if batch and (characters + embed_characters > NotificationQueue.MAX_EMBED_CHARACTERS):
+                break
+            batch.append(pending.popleft())
+            characters += embed_characters
+        return batch
+    async def send_pending(self, channel):
+        pending = self.pending[channel.id]
+        try:
+            while pending:
+                # embeds queued while waiting for the rate limiter go out in the same message
+                await self.tobman.rate_limiter.acquire(RateLimiter.SEND_MESSAGE, channel.id)
+                batch = NotificationQueue.next_batch(pending)
+                self.set_depth(self.depth - len(batch))
+                try:
+                    await channel.send(embeds = [embed for embed, queued_at in batch])
+                except discord.HTTPException as err:
+                    print(f'Error sending {len(batch)} notification(s) to channel {channel.id}: {err}', file=sys.stderr)
+                now = time.perf_counter()
+                self.tobman.metrics.inc(Metrics.NOTIFICATION_MESSAGES, embeds = len(batch))
+                for embed, queued_at in batch:
+                    self.tobman.metrics.observe(Metrics.NOTIFICATION_LATENCY, now - queued_at)
+        finally:
+            # nothing is awaited between the last check of the deque and this, so no notification is left behind
+            del self.tasks[channel.id]
+            if not pending:
+                del self.pending[channel.id]
+    async def flush_channel(self, channel_id):
+        while channel_id in self.tasks:
+            # a caller being cancelled does not cancel the sending
+            await asyncio.shield(self.tasks[channel_id])
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions = True)
+
+class PendingReactions:
+    def __init__(self, event):
+        self.event = event
+        self.ok_before = None
+        self.ng_before = None
+        if event.has_roster():
+            self.ok_before = set(event.ok_user_ids)
+            self.ng_before = set(event.ng_user_ids)
+        # user id -> True if the user joined, False if the user left, in arrival order
+        self.statuses = {}
+        self.task = None
+    def add(self, user_id, joined):
+        if joined is not None:
+            self.statuses.pop(user_id, None)
+            self.statuses[user_id] = joined
+    def changes(self):
+        if (self.ok_before is None) or (not self.event.has_roster()):
+            joined_ids = [user_id for user_id, joined in self.statuses.items() if joined]
+            left_ids = [user_id for user_id, joined in self.statuses.items() if not joined]
+            return joined_ids, left_ids
+        # compare the roster before and after the burst so that undone reactions are not announced
+        ok_after = self.event.ok_user_ids
+        ng_after = self.event.ng_user_ids
+        joined_ids = [user_id for user_id in self.statuses if (user_id in ok_after) and (user_id not in self.ok_before)]
+        left_ids = [user_id for user_id in self.statuses if (user_id not in joined_ids) and
+            (((user_id in self.ok_before) and (user_id not in ok_after)) or ((user_id in ng_after) and (user_id not in self.ng_before)))]
+        return joined_ids, left_ids
+
+class ReactionDebouncer:
+    DEFAULT_WINDOW = 2.0
+    def __init__(self, tobman, window = DEFAULT_WINDOW):
+        self.tobman = tobman
+        self.window = window
+        self.pending = {}
+        self.tasks = set()
+    def add(self, event, user_id, joined):
+        pending = self.pending.get(event.message_id)
+        if pending is None:
+            pending = self.pending[event.message_id] = PendingReactions(event)
+            pending.task = asyncio.create_task(self.flush_later(event.message_id))
+            self.tasks.add(pending.task)
+            pending.task.add_done_callback(self.tasks.discard)
+        pending.add(user_id, joined)
+    async def flush_later(self, message_id):
+        await asyncio.sleep(self.window)
+        pending = self.pending.pop(message_id, None)
+        if pending is not None:
+            await self.flush(pending)
+    async def flush(self, pending):
+        try:
+            await self.tobman.flush_event_reactions(pending)
+        except Exception as err:
+            print(f'Error handling reactions for message {pending.event.message_id}: {err}', file=sys.stderr)
+    async def stop(self):
+        # the reactions still waiting for their window are handled now, the ones being handled are waited for
+        waiting = list(self.pending.values())
+        self.pending.clear()
+        for pending in waiting:
+            pending.task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions = True)
+        for pending in waiting:
+            await self.flush(pending)
+
+class CalendarFeed:
+    PRODID = '-//tobman//calendar feed//FR'
+    MAX_AGE = 300
+    def __init__(self, tobman):
+        self.tobman = tobman
+        # message id -> (Event.ics_key(), VEVENT lines)
+        self.event_lines = {}
+        # room id -> (ics bytes, etag)
+        self.feeds = {}
+    def invalidate(self, guild_id, channel_id):
+        self.feeds.pop(Event.format_room_id(guild_id, channel_id), None)
+    def forget_event(self, event):
+        self.event_lines.pop(event.message_id, None)
+        self.invalidate(event.guild_id, event.channel_id)
+    def event_ics_lines(self, event):
+        ics_key = event.ics_key()
+        cached = self.event_lines.get(event.message_id)
+        if (cached is None) or (cached[0] != ics_key):
+            cached = self.event_lines[event.message_id] = (ics_key, event.generate_ics_lines())
+        return cached[1]
+    def get_feed(self, guild_id, channel_id):
+        id_str = Event.format_room_id(guild_id, channel_id)
+        feed = self.feeds.get(id_str)
+        if (feed is None) and (id_str in self.tobman.events):
+            lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{self.PRODID}']
+            channel = self.tobman.bot.get_channel(channel_id)
+            if channel:
+                lines.append(f'X-WR-CALNAME:#{channel.name}')
+            for event in self.tobman.events[id_str] or []:
+                if event.date:
+                    lines.extend(self.event_ics_lines(event))
+            lines.append('END:VCALENDAR')
+            body = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+            feed = self.feeds[id_str] = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+        return feed
+    def etag_matches(if_none_match, etag):
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag or tag == '*':
+                return True
+        return False
+    async def handle_request(self, request):
+        guild_id = int(request.match_info['guild_id'])
+        channel_id = int(request.match_info['channel_id'])
+        feed = self.get_feed(guild_id, channel_id)
+        if feed is None:
+            raise web.HTTPNotFound()
+        body, etag = feed
+        headers = { 'ETag': etag, 'Cache-Control': f'max-age={self.MAX_AGE}' }
+        if CalendarFeed.etag_matches(request.headers.get('If-None-Match', ''), etag):
+            return web.Response(status = 304, headers = headers)
+        return web.Response(body = body, content_type = 'text/calendar', charset = 'utf-8', headers = headers)
+
+class EventListPages:
+    # every event is an embed field and an embed holds at most 25 fields
+    PAGE_SIZE = 10
+    def __init__(self, tobman):
+        self.tobman = tobman
+        # room id -> (day rendered, active events, rendered page embeds or None until a page is shown)
+        self.pages = {}
+    def invalidate(self, guild_id, channel_id):
+        self.pages.pop(Event.format_room_id(guild_id, channel_id), None)
+    def render_page(self, channel, active_events, page_index, page_count):
+        embed = discord.Embed(title = Translation.EVENTS_LIST_TITLE.format(channel.name),
+            type = 'rich',
+            description = Translation.EVENTS_LIST_DESC.format(channel.name, len(active_events))
+        )
+        for event in active_events[page_index * self.PAGE_SIZE:(page_index + 1) * self.PAGE_SIZE]:
+            embed.add_field(name = event.title, value = event.summary())
+        if page_count > 1:
+            embed.set_footer(text = Translation.EVENTS_LIST_PAGE.format(page_index + 1, page_count))
+        return embed
+    def get_page(self, channel, page_index):
+        id_str = Event.format_room_id(channel.guild.id, channel.id)
+        today = datetime.date.today()
+        cached = self.pages.get(id_str)
+        # the remaining days shown in the summaries change every day
+        if (cached is None) or (cached[0] != today):
+            active_events = [event for event in self.tobman.events.get(id_str) or [] if event.still_active()]
+            page_count = max(1, (len(active_events) + self.PAGE_SIZE - 1) // self.PAGE_SIZE)
+            cached = self.pages[id_str] = (today, active_events, [None] * page_count)
+        today, active_events, embeds = cached
+        page_index = max(0, min(page_index, len(embeds) - 1))
+        if embeds[page_index] is None:
+            embeds[page_index] = self.render_page(channel, active_events, page_index, len(embeds))
+        return page_index, len(embeds), embeds[page_index]
+
+class EventListView(discord.ui.View):
+    TIMEOUT = 600
+    def __init__(self, pages, channel, page_index = 0):
+        super().__init__(timeout = self.TIMEOUT)
+        self.pages = pages
+        self.channel = channel
+        self.page_index = page_index
+    def update_buttons(self, page_count):
+        self.previous_page.disabled = (self.page_index <= 0)
+        self.next_page.disabled = (self.page_index >= page_count - 1)
+    async def show_page(self, interaction, page_index):
+        self.page_index, page_count, embed = self.pages.get_page(self.channel, page_index)
+        self.update_buttons(page_count)
+        await interaction.response.edit_message(embed = embed, view = self)
+    @discord.ui.button(label = '◀', style = discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show_page(interaction, self.page_index - 1)
+    @discord.ui.button(label = '▶', style = discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show_page(interaction, self.page_index + 1)
+
+class TitleIndex:
+    MAX_SUGGESTIONS = 25
+    # shorter typed words are not corrected, too many words are one letter away from them
+    MIN_CORRECTED_WORD_LENGTH = 3
+    def __init__(self, tobman):
+        self.tobman = tobman
+        # room id -> sorted list of (normalized title, message id)
+        self.rooms = {}
+        # message id -> normalized title
+        self.keys = {}
+        # room id -> Counter of the words of the titles
+        self.words = {}
+        # room id -> word with one letter deleted -> words, to correct the typed words
+        self.word_variants = {}
+    def normalize(title):
+        return ' '.join(str(title).casefold().split())
+    def deletions(word):
+        return set([word] + [word[:index] + word[index + 1:] for index in range(len(word))])
+    def add(self, event):
+        if event.message_id in self.keys:
+            self.remove(event)
+        id_str = Event.format_room_id(event.guild_id, event.channel_id)
+        key = self.keys[event.message_id] = TitleIndex.normalize(event.title)
+        bisect.insort(self.rooms.setdefault(id_str, []), (key, event.message_id))
+        words = self.words.setdefault(id_str, collections.Counter())
+        word_variants = self.word_variants.setdefault(id_str, {})
+        for word in key.split():
+            if words[word] == 0:
+                for variant in TitleIndex.deletions(word):
+                    word_variants.setdefault(variant, set()).add(word)
+            words[word] += 1
+    def remove(self, event):
+        key = self.keys.pop(event.message_id, None)
+        id_str = Event.format_room_id(event.guild_id, event.channel_id)
+        entries = self.rooms.get(id_str)
+        if (key is not None) and entries:
+            index = bisect.bisect_left(entries, (key, event.message_id))
+            if (index < len(entries)) and (entries[index] == (key, event.message_id)):
+                del entries[index]
+            words = self.words[id_str]
+            word_variants = self.word_variants[id_str]
+            for word in key.split():
+                words[word] -= 1
+                if words[word] <= 0:
+                    del words[word]
+                    for variant in TitleIndex.deletions(word):
+                        word_variants[variant].discard(word)
+                        if not word_variants[variant]:
+                            del word_variants[variant]
+    def update(self, event):
+        if self.keys.get(event.message_id) != TitleIndex.normalize(event.title):
+            self.add(event)
+    def clear(self, guild_id, channel_id):
+        id_str = Event.format_room_id(guild_id, channel_id)
+        for key, message_id in self.rooms.pop(id_str, []):
+            self.keys.pop(message_id, None)
+        self.words.pop(id_str, None)
+        self.word_variants.pop(id_str, None)
+    def next_key_index(entries, key, start = 0):
+        # every entry of a title sorts before the title followed by the smallest character
+        return bisect.bisect_left(entries, (key + '\0',), start)
+    def find(self, guild_id, channel_id, title):
+        key = TitleIndex.normalize(title)
+        entries = self.rooms.get(Event.format_room_id(guild_id, channel_id)) or []
+        start = bisect.bisect_left(entries, (key,))
+        end = TitleIndex.next_key_index(entries, key, start)
+        events = (self.tobman.events_by_message_id.get(message_id) for title_key, message_id in entries[start:end])
+        return [event for event in events if event is not None]
+    def add_prefix_keys(entries, prefix, suggested_keys, limit):
+        index = bisect.bisect_left(entries, (prefix,))
+        while (index < len(entries)) and entries[index][0].startswith(prefix) and (len(suggested_keys) < limit):
+            if entries[index][0] not in suggested_keys:
+                suggested_keys.append(entries[index][0])
+            index = TitleIndex.next_key_index(entries, entries[index][0], index)
+    def correct_word(self, id_str, word):
+        words = self.words.get(id_str) or {}
+        if (word in words) or (len(word) < self.MIN_CORRECTED_WORD_LENGTH):
+            return word
+        # the known words one deletion, insertion, substitution or swap away, the most used one first
+        word_variants = self.word_variants.get(id_str) or {}
+        candidates = set()
+        for variant in TitleIndex.deletions(word):
+            candidates |= word_variants.get(variant, set())
+        if not candidates:
+            return word
+        return max(sorted(candidates), key = lambda candidate: words[candidate])
+    def suggest(self, guild_id, channel_id, text, limit = MAX_SUGGESTIONS):
+        key = TitleIndex.normalize(text)
+        id_str = Event.format_room_id(guild_id, channel_id)
+        entries = self.rooms.get(id_str) or []
+        suggested_keys = []
+        TitleIndex.add_prefix_keys(entries, key, suggested_keys, limit)
+        if key and (len(suggested_keys) < limit):
+            typed_words = key.split(' ')
+            corrected_words = [self.correct_word(id_str, word) for word in typed_words]
+            # the last word may still be being typed, it is first kept as it is
+            for corrected_key in [' '.join(corrected_words[:-1] + typed_words[-1:]), ' '.join(corrected_words)]:
+                if corrected_key != key:
+                    TitleIndex.add_prefix_keys(entries, corrected_key, suggested_keys, limit)
+        # the latest event of each suggested title
+        suggested_events = []
+        for suggested_key in suggested_keys:
+            events = self.find(guild_id, channel_id, suggested_key)
+            if events:
+                suggested_events.append(events[-1])
+        return suggested_events
+
+class ConfigWatcher:
+    DEFAULT_INTERVAL = 10.0
+    def __init__(self, tobman, interval = DEFAULT_INTERVAL):
+        self.tobman = tobman
+        self.interval = interval
+        self.mtime = None
+        self.task = None
+    def config_mtime(self):
+        try:
+            return os.stat(self.tobman.config_filename).st_mtime_ns
+        except OSError:
+            return None
+    def start(self):
+        self.mtime = self.config_mtime()
+        if (self.interval > 0) and (self.task is None):
+            self.task = asyncio.create_task(self.run())
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self.config_mtime()
+            if (mtime is not None) and (mtime != self.mtime):
+                self.mtime = mtime
+                self.tobman.reload_config()
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+class TobmanWebServer:
+    DEFAULT_HOST = '127.0.0.1'
+    def __init__(self):
+        self.app = web.Application()
+        self.runner = None
+        self.host = self.DEFAULT_HOST
+        self.port = None
+    def add_route(self, method, path, handler):
+        self.app.router.add_route(method, path, handler)
+    async def start(self):
+        if self.port is not None:
+            self.runner = web.AppRunner(self.app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, self.host, self.port)
+            await site.start()
+            print(f'Serving HTTP on {self.host}:{self.port}')
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+class EventJournal:
+    ADD = 'add'
+    UPDATE = 'upd'
+    REMOVE = 'del'
+    CLEAR = 'clr'
+    DEFAULT_COMPACT_THRESHOLD = 1000
+    def __init__(self, filename, compact_threshold = DEFAULT_COMPACT_THRESHOLD):
+        self.filename = filename
+        self.compact_threshold = compact_threshold
+        self.seq = 0
+        self.record_count = 0
+        self.file = None
+    def open(self):
+        self.file = open(self.filename, 'a', encoding='utf-8')
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    def append(self, op, flush = True, **fields):
+        self.seq += 1
+        record = { 'op': op, 's': self.seq }
+        record.update(fields)
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        if flush:
+            self.file.flush()
+        self.record_count += 1
+    def flush(self):
+        self.file.flush()
+    def read(self, after_seq = 0):
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as err:
+                    # a crash in the middle of an append leaves a partial last line
+                    print(f'Ignoring unreadable journal record in {self.filename}: {err}', file=sys.stderr)
+                    continue
+                seq = int(record.get('s', 0))
+                self.seq = max(self.seq, seq)
+                if seq > after_seq:
+                    self.record_count += 1
+                    yield record
+    def needs_compaction(self):
+        return self.record_count >= self.compact_threshold
+    def discard_through(self, seq):
+        self.close()
+        self.record_count = 0
+        kept_records = list(self.read(after_seq = seq))
+        temp_filename = f'{self.filename}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as journal_file:
+            for record in kept_records:
+                journal_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        os.replace(temp_filename, self.filename)
+        self.open()
+
+class DataPersister:
+    DEFAULT_INTERVAL = 5.0
+    def __init__(self, storage, interval = DEFAULT_INTERVAL):
+        self.storage = storage
+        self.interval = interval
+        self.dirty = False
+        self.dirty_event = None
+        self.lock = None
+        self.task = None
+        self.stop_event = None
+        self.write_count = 0
+    def running(self):
+        return (self.task is not None) and (not self.task.done())
+    def start(self):
+        self.dirty_event = asyncio.Event()
+        self.stop_event = asyncio.Event()
+        self.lock = asyncio.Lock()
+        if self.dirty:
+            self.dirty_event.set()
+        self.task = asyncio.create_task(self.run())
+    def mark_dirty(self):
+        self.dirty = True
+        if self.dirty_event is not None:
+            self.dirty_event.set()
+    async def run(self):
+        while not self.stop_event.is_set():
+            await self.dirty_event.wait()
+            if self.stop_event.is_set():
+                break
+            # let the rest of a burst of changes pile up before writing, stop() cuts the wait short
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.stop_event.wait(), self.interval)
+            try:
+                # a write in progress is finished even when the task is cancelled, stop() waits for it on the lock
+                await asyncio.shield(self.flush())
+            except Exception as err:
+                print(f'Error writing {self.storage.filename}: {err}', file=sys.stderr)
+                self.mark_dirty()
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.dirty_event.clear()
+            data_json = self.storage.snapshot_data()
+            await asyncio.to_thread(self.storage.write_data, data_json)
+            self.write_count += 1
+            self.storage.data_written(data_json)
+    async def stop(self):
+        if self.task is not None:
+            # the task is not cancelled, a write in progress always ends before the final one starts
+            self.stop_event.set()
+            self.dirty_event.set()
+            await self.task
+            self.task = None
+        if self.lock is not None:
+            await self.flush()
+
+class EventStorage:
+    def __init__(self, tobman):
+        self.tobman = tobman
+    def load(self):
+        pass
+    def load_guild(self, guild_id):
+        return {}
+    def stored_rooms(self):
+        return []
+    async def claim_reminder(self, event, days_remaining):
+        return True
+    def start(self):
+        pass
+    async def close(self):
+        pass
+    def save(self):
+        pass
+    def events_added(self, events):
+        if len(events) > 0:
+            self.save()
+    def event_updated(self, event):
+        self.save()
+    def events_removed(self, events):
+        if len(events) > 0:
+            self.save()
+    def events_changed(self, updated_events, removed_events):
+        if len(updated_events) + len(removed_events) > 0:
+            self.save()
+    def channel_cleared(self, guild_id, channel_id):
+        self.save()
+
+class JsonEventStorage(EventStorage):
+    STORAGE_NAME = 'json'
+    WRITE_MODE = 'w'
+    def __init__(self, tobman, filename, journal = None, save_interval = DataPersister.DEFAULT_INTERVAL):
+        super().__init__(tobman)
+        self.filename = filename
+        self.journal = journal
+        self.persister = DataPersister(self, save_interval)
+        # guild id -> room id -> serialized events of the guilds that are not loaded yet
+        self.unloaded_guilds = {}
+        # room id -> (event list, serialized events) of the loaded rooms, the serialized lists are never changed in place
+        self.serialized_rooms = {}
+        self.changed_rooms = set()
+    def read_snapshot(self):
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as data_file:
+                return json.load(data_file)
+        return None
+    def unloaded_rooms(self, guild_id):
+        rooms = self.unloaded_guilds.get(guild_id)
+        if rooms is None:
+            rooms = self.unloaded_guilds[guild_id] = {}
+        return rooms
+    def load(self):
+        snapshot_seq = 0
+        self.unloaded_guilds = {}
+        data_json = self.read_snapshot()
+        if data_json is not None:
+            snapshot_seq = int(data_json.get('journal_seq', 0))
+            if 'events' in data_json:
+                for channel_id_key, event_list_json in data_json['events'].items():
+                    guild_id, channel_id = Event.parse_room_id(channel_id_key)
+                    if guild_id is not None:
+                        self.unloaded_rooms(guild_id)[channel_id_key] = event_list_json
+                print(f'Read {len(data_json["events"])} event channel(s) from {self.filename}')
+        if self.journal:
+            for record in self.journal.read(after_seq = snapshot_seq):
+                self.apply_journal_record(record)
+            print(f'Replayed {self.journal.record_count} journal record(s) from {self.journal.filename}')
+            self.journal.open()
+            if self.journal.record_count > 0:
+                self.compact_journal()
+    def stored_rooms(self):
+        return [Event.parse_room_id(channel_id_key) for rooms in self.unloaded_guilds.values() for channel_id_key in rooms]
+    def load_guild(self, guild_id):
+        events = {}
+        for channel_id_key, event_list_json in self.unloaded_guilds.pop(guild_id, {}).items():
+            if event_list_json is None:
+                events[channel_id_key] = None
+            else:
+                event_list = events[channel_id_key] = self.deserialize_events(event_list_json)
+                # the room is written back as it was read until it changes
+                record_count = event_list_json.record_count if isinstance(event_list_json, SnapshotRoom) else len(event_list_json)
+                if len(event_list) == record_count:
+                    self.serialized_rooms[channel_id_key] = (event_list, event_list_json)
+        return events
+    def deserialize_events(self, event_list_json):
+        return [event for event in map(Event.from_deserializable, event_list_json) if event is not None]
+    def start(self):
+        self.persister.start()
+    async def close(self):
+        await self.persister.stop()
+    def snapshot_data(self):
+        data_json = {}
+        data_json['events'] = {}
+        if self.journal:
+            data_json['journal_seq'] = self.journal.seq
+        for rooms in self.unloaded_guilds.values():
+            for channel_id_key, event_list_json in rooms.items():
+                if event_list_json is not None:
+                    data_json['events'][channel_id_key] = event_list_json
+        # only the rooms that changed since the last snapshot are serialized again
+        changed_rooms = self.changed_rooms
+        self.changed_rooms = set()
+        for channel_id_key, event_list in self.tobman.events.items():
+            if event_list is None:
+                self.serialized_rooms.pop(channel_id_key, None)
+                continue
+            serialized_room = self.serialized_rooms.get(channel_id_key)
+            if (serialized_room is None) or (serialized_room[0] is not event_list) or (channel_id_key in changed_rooms):
+                serialized_room = self.serialized_rooms[channel_id_key] = (event_list, [event.to_serializable() for event in event_list])
+            data_json['events'][str(channel_id_key)] = serialized_room[1]
+        return data_json
+    def room_changed(self, guild_id, channel_id):
+        self.changed_rooms.add(Event.format_room_id(guild_id, channel_id))
+    def write_data(self, data_json):
+        temp_filename = f'{self.filename}.tmp'
+        with self.tobman.metrics.timer(Metrics.SAVE_DURATION, storage = self.STORAGE_NAME):
+            with open(temp_filename, self.WRITE_MODE) as data_file:
+                self.dump_data(data_json, data_file)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            os.replace(temp_filename, self.filename)
+        self.tobman.metrics.set(Metrics.SAVE_BYTES, os.path.getsize(self.filename), storage = self.STORAGE_NAME)
+    def dump_data(self, data_json, data_file):
+        json.dump(data_json, data_file)
+    def data_written(self, data_json):
+        if self.journal:
+            self.journal.discard_through(data_json['journal_seq'])
+    def save(self):
+        if self.persister.running():
+            self.persister.mark_dirty()
+        else:
+            data_json = self.snapshot_data()
+            self.write_data(data_json)
+            self.data_written(data_json)
+    def compact_journal(self):
+        if not self.persister.dirty:
+            print(f'Compacting journal {self.journal.filename} ({self.journal.record_count} record(s))')
+            self.save()
+    def apply_journal_record(self, record):
+        # replayed at startup, before any guild is loaded
+        op = record.get('op')
+        if op in (EventJournal.ADD, EventJournal.UPDATE):
+            event_json = record['e']
+            rooms = self.unloaded_rooms(int(event_json['g']))
+            id_str = Event.format_room_id(event_json['g'], event_json['c'])
+            event_list_json = rooms.get(id_str)
+            if event_list_json is None:
+                event_list_json = rooms[id_str] = []
+            for index, existing_event_json in enumerate(event_list_json):
+                if existing_event_json.get('m') == event_json['m']:
+                    event_list_json[index] = event_json
+                    break
+            else:
+                event_list_json.append(event_json)
+        elif op == EventJournal.REMOVE:
+            event_list_json = self.unloaded_rooms(record['g']).get(Event.format_room_id(record['g'], record['c']))
+            if event_list_json:
+                event_list_json[:] = [event_json for event_json in event_list_json if event_json.get('m') != record['m']]
+        elif op == EventJournal.CLEAR:
+            self.unloaded_rooms(record['g'])[Event.format_room_id(record['g'], record['c'])] = None
+        else:
+            print(f'Unknown journal operation {op}', file=sys.stderr)
+    def append_journal(self, op, **fields):
+        self.journal.append(op, **fields)
+        if self.journal.needs_compaction():
+            self.compact_journal()
+    def events_added(self, events):
+        for event in events:
+            self.room_changed(event.guild_id, event.channel_id)
+        if self.journal:
+            for event in events:
+                self.journal.append(EventJournal.ADD, flush = False, e = event.to_serializable())
+            self.journal.flush()
+            if self.journal.needs_compaction():
+                self.compact_journal()
+        elif len(events) > 0:
+            self.save()
+    def event_updated(self, event):
+        self.room_changed(event.guild_id, event.channel_id)
+        if self.journal:
+            self.append_journal(EventJournal.UPDATE, e = event.to_serializable())
+        else:
+            self.save()
+    def events_removed(self, events):
+        for event in events:
+            self.room_changed(event.guild_id, event.channel_id)
+        if self.journal:
+            for event in events:
+                self.append_journal(EventJournal.REMOVE, g = event.guild_id, c = event.channel_id, m = event.message_id)
+        elif len(events) > 0:
+            self.save()
+    def events_changed(self, updated_events, removed_events):
+        for event in updated_events + removed_events:
+            self.room_changed(event.guild_id, event.channel_id)
+        if self.journal:
+            for event in updated_events:
+                self.journal.append(EventJournal.UPDATE, flush = False, e = event.to_serializable())
+            for event in removed_events:
+                self.journal.append(EventJournal.REMOVE, flush = False, g = event.guild_id, c = event.channel_id, m = event.message_id)
+            self.journal.flush()
+            if self.journal.needs_compaction():
+                self.compact_journal()
+        elif len(updated_events) + len(removed_events) > 0:
+            self.save()
+    def channel_cleared(self, guild_id, channel_id):
+        self.room_changed(guild_id, channel_id)
+        if self.journal:
+            self.append_journal(EventJournal.CLEAR, g = guild_id, c = channel_id)
+        else:
+            self.save()
+
+class SnapshotRoom:
+    # the still encoded events of a room, read from the snapshot only when the guild is loaded
+    def __init__(self, buffer, start, end, record_count):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.record_count = record_count
+    def record_offsets(self):
+        offset = self.start
+        while offset < self.end:
+            (length,) = EventSnapshot.LENGTH.unpack_from(self.buffer, offset)
+            offset += EventSnapshot.LENGTH.size
+            yield offset
+            offset += length
+    def raw(self):
+        return self.buffer[self.start:self.end]
+    def events(self):
+        return [EventSnapshot.hydrate(self.buffer, offset) for offset in self.record_offsets()]
+    def to_json(self):
+        return [EventSnapshot.to_event_json(self.buffer, offset) for offset in self.record_offsets()]
+
+class EventSnapshot:
+    MAGIC = b'TOBSNAP1'
+    # magic, journal sequence, room count
+    HEADER = struct.Struct('<8sQI')
+    # room id length, record count, byte length of the records
+    ROOM = struct.Struct('<HII')
+    LENGTH = struct.Struct('<I')
+    # guild, channel, message, command message, original user (0 if none), date ordinal (0 if none), ok and ng counts (-1 without roster)
+    FIELDS = struct.Struct('<QQQQQiii')
+    # strings stored after the roster ids, in this order
+    STRING_KEYS = ('t', 'url', 'desc', 'loc', 'th', 'ed')
+    def is_snapshot(filename):
+        with open(filename, 'rb') as data_file:
+            return data_file.read(len(EventSnapshot.MAGIC)) == EventSnapshot.MAGIC
+    def map_file(filename):
+        with open(filename, 'rb') as data_file:
+            return mmap.mmap(data_file.fileno(), 0, access = mmap.ACCESS_READ)
+    def encode_record(event_json):
+        ok_ids = ng_ids = None
+        if ('ok' in event_json) and ('ng' in event_json):
+            ok_ids = [int(user_id) for user_id in event_json['ok']]
+            ng_ids = [int(user_id) for user_id in event_json['ng']]
+        date_ordinal = 0
+        if event_json.get('date'):
+            date_ordinal = datetime.datetime.strptime(event_json['date'], Event.DATE_FORMAT).toordinal()
+        parts = [EventSnapshot.FIELDS.pack(int(event_json['g']), int(event_json['c']), int(event_json['m']), int(event_json['cm']),
+            int(event_json.get('ouid') or 0), date_ordinal, -1 if ok_ids is None else len(ok_ids), -1 if ng_ids is None else len(ng_ids))]
+        if ok_ids is not None:
+            parts.append(struct.pack(f'<{len(ok_ids)}Q', *ok_ids))
+            parts.append(struct.pack(f'<{len(ng_ids)}Q', *ng_ids))
+        for key in EventSnapshot.STRING_KEYS:
+            value = str(event_json.get(key) or '').encode('utf-8')
+            parts.append(EventSnapshot.LENGTH.pack(len(value)))
+            parts.append(value)
+        record = b''.join(parts)
+        return EventSnapshot.LENGTH.pack(len(record)) + record
+    def decode_record(buffer, offset):
+        guild_id, channel_id, message_id, command_message_id, original_user_id, date_ordinal, ok_count, ng_count = EventSnapshot.FIELDS.unpack_from(buffer, offset)
+        offset += EventSnapshot.FIELDS.size
+        ok_ids = ng_ids = None
+        if ok_count >= 0:
+            ok_ids = struct.unpack_from(f'<{ok_count}Q', buffer, offset)
+            offset += 8 * ok_count
+            ng_ids = struct.unpack_from(f'<{ng_count}Q', buffer, offset)
+            offset += 8 * ng_count
+        strings = []
+        for key in EventSnapshot.STRING_KEYS:
+            (length,) = EventSnapshot.LENGTH.unpack_from(buffer, offset)
+            offset += EventSnapshot.LENGTH.size
+            strings.append(str(buffer[offset:offset + length], 'utf-8'))
+            offset += length
+        return (guild_id, channel_id, message_id, command_message_id, original_user_id, date_ordinal, ok_ids, ng_ids, strings)
+    def hydrate(buffer, offset):
+        guild_id, channel_id, message_id, command_message_id, original_user_id, date_ordinal, ok_ids, ng_ids, strings = EventSnapshot.decode_record(buffer, offset)
+        title, url_string, description, location, url_thumbnail, embed_digest = strings
+        event = Event(title)
+        event.set_ids(guild_id, channel_id, message_id, command_message_id)
+        if url_string:
+            event.set_url(url_string)
+        event.description = description
+        event.location = location
+        event.url_thumbnail = url_thumbnail or None
+        event.embed_digest = embed_digest or None
+        if date_ordinal:
+            event.date = datetime.datetime.fromordinal(date_ordinal).replace(hour=11, minute=59)
+        if original_user_id:
+            event.original_user_id = original_user_id
+        if ok_ids is not None:
+            event.ok_user_ids = set(ok_ids)
+            event.ng_user_ids = set(ng_ids)
+        return event
+    def to_event_json(buffer, offset):
+        guild_id, channel_id, message_id, command_message_id, original_user_id, date_ordinal, ok_ids, ng_ids, strings = EventSnapshot.decode_record(buffer, offset)
+        event_json = { 'g': guild_id, 'c': channel_id, 'm': message_id, 'cm': command_message_id }
+        for key, value in zip(EventSnapshot.STRING_KEYS, strings):
+            if value or key == 't':
+                event_json[key] = value
+        if date_ordinal:
+            event_json['date'] = datetime.date.fromordinal(date_ordinal).strftime(Event.DATE_FORMAT)
+        if original_user_id:
+            event_json['ouid'] = original_user_id
+        if ok_ids is not None:
+            event_json['ok'] = list(ok_ids)
+            event_json['ng'] = list(ng_ids)
+        return event_json
+    def read(buffer):
+        magic, journal_seq, room_count = EventSnapshot.HEADER.unpack_from(buffer, 0)
+        if magic != EventSnapshot.MAGIC:
+            raise ValueError('not a tobman snapshot')
+        offset = EventSnapshot.HEADER.size
+        rooms = {}
+        for room_index in range(room_count):
+            key_length, record_count, records_length = EventSnapshot.ROOM.unpack_from(buffer, offset)
+            offset += EventSnapshot.ROOM.size
+            channel_id_key = str(buffer[offset:offset + key_length], 'utf-8')
+            offset += key_length
+            rooms[channel_id_key] = SnapshotRoom(buffer, offset, offset + records_length, record_count)
+            offset += records_length
+        return { 'journal_seq': journal_seq, 'events': rooms }
+    def write(data_file, data_json):
+        rooms = data_json.get('events', {})
+        data_file.write(EventSnapshot.HEADER.pack(EventSnapshot.MAGIC, int(data_json.get('journal_seq', 0)), len(rooms)))
+        for channel_id_key, event_list_json in rooms.items():
+            if isinstance(event_list_json, SnapshotRoom):
+                # rooms of guilds that were never loaded are copied without decoding them
+                record_count, records = event_list_json.record_count, event_list_json.raw()
+            else:
+                encoded_records = []
+                for event_json in event_list_json:
+                    try:
+                        encoded_records.append(EventSnapshot.encode_record(event_json))
+                    except (KeyError, TypeError, ValueError) as err:
+                        print(f'Error encoding event {event_json}: {err}', file=sys.stderr)
+                record_count, records = len(encoded_records), b''.join(encoded_records)
+            key_bytes = str(channel_id_key).encode('utf-8')
+            data_file.write(EventSnapshot.ROOM.pack(len(key_bytes), record_count, len(records)))
+            data_file.write(key_bytes)
+            data_file.write(records)
+    def convert(source_filename, destination_filename):
+        if EventSnapshot.is_snapshot(source_filename):
+            data_json = EventSnapshot.read(EventSnapshot.map_file(source_filename))
+            data_json['events'] = { channel_id_key: room.to_json() for channel_id_key, room in data_json['events'].items() }
+        else:
+            with open(source_filename, 'r') as data_file:
+                data_json = json.load(data_file)
+        if destination_filename.endswith('.json'):
+            with open(destination_filename, 'w') as data_file:
+                json.dump(data_json, data_file)
+        else:
+            with open(destination_filename, 'wb') as data_file:
+                EventSnapshot.write(data_file, data_json)
+        print(f'Converted {len(data_json.get("events", {}))} event channel(s) from {source_filename} to {destination_filename}')
+
+class SnapshotEventStorage(JsonEventStorage):
+    STORAGE_NAME = 'snapshot'
+    WRITE_MODE = 'wb'
+    def __init__(self, tobman, filename, json_filename = None, journal = None, save_interval = DataPersister.DEFAULT_INTERVAL):
+        super().__init__(tobman, filename, journal, save_interval)
+        self.json_filename = json_filename
+    def read_snapshot(self):
+        if os.path.isfile(self.filename) and os.path.getsize(self.filename) > 0:
+            # the map stays open as long as rooms of unloaded guilds point into it
+            return EventSnapshot.read(EventSnapshot.map_file(self.filename))
+        if (self.json_filename is not None) and os.path.isfile(self.json_filename):
+            print(f'Reading {self.json_filename}, it will be saved to {self.filename}')
+            with open(self.json_filename, 'r') as data_file:
+                return json.load(data_file)
+        return None
+    def deserialize_events(self, event_list_json):
+        if isinstance(event_list_json, SnapshotRoom):
+            return event_list_json.events()
+        return super().deserialize_events(event_list_json)
+    def dump_data(self, data_json, data_file):
+        EventSnapshot.write(data_file, data_json)
+    def apply_journal_record(self, record):
+        # journal records edit serialized events, decode the room they touch
+        room_json = record.get('e', record)
+        if ('g' in room_json) and ('c' in room_json):
+            rooms = self.unloaded_rooms(int(room_json['g']))
+            id_str = Event.format_room_id(room_json['g'], room_json['c'])
+            if isinstance(rooms.get(id_str), SnapshotRoom):
+                rooms[id_str] = rooms[id_str].to_json()
+        super().apply_journal_record(record)
+
+class SqliteEventStorage(EventStorage):
+    STORAGE_NAME = 'sqlite'
+    SCHEMA = [
+        # lookups by title and date go through the in-memory indexes, the database is only read when a guild is loaded
+        'CREATE TABLE IF NOT EXISTS events (guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, message_id INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (guild_id, channel_id, message_id))',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS reminders (message_id INTEGER NOT NULL, reminder_date TEXT NOT NULL, days_remaining INTEGER NOT NULL, PRIMARY KEY (message_id, reminder_date, days_remaining))',
+    ]
+    # shard processes share the database, wait a little for the other writers, the writes never run on the event loop
+    BUSY_TIMEOUT = 5.0
+    UPSERT_EVENT = 'INSERT INTO events (guild_id, channel_id, message_id, data) VALUES (?, ?, ?, ?) ON CONFLICT (guild_id, channel_id, message_id) DO UPDATE SET data = excluded.data'
+    DELETE_EVENT = 'DELETE FROM events WHERE guild_id = ? AND channel_id = ? AND message_id = ?'
+    META_JSON_MIGRATED = 'json_migrated'
+    def __init__(self, tobman, filename, json_filename = None):
+        super().__init__(tobman)
+        self.filename = filename
+        self.json_filename = json_filename
+        # read when loading, used by the event loop
+        self.connection = None
+        # changes go to a single thread, in order, with their own connection
+        self.writer = None
+        self.write_connection = None
+        # reminder claims of older days are deleted once a day
+        self.pruned_date = None
+    def open_connection(self):
+        connection = sqlite3.connect(self.filename, timeout = self.BUSY_TIMEOUT)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+        return connection
+    def connect(self):
+        if self.connection is None:
+            self.connection = self.open_connection()
+        return self.connection
+    def run_write(self, statements):
+        # runs on the writer thread
+        try:
+            if self.write_connection is None:
+                self.write_connection = self.open_connection()
+            with self.tobman.metrics.timer(Metrics.SAVE_DURATION, storage = self.STORAGE_NAME):
+                with self.write_connection as connection:
+                    result = statements(connection)
+            self.tobman.metrics.set(Metrics.SAVE_BYTES, os.path.getsize(self.filename), storage = self.STORAGE_NAME)
+            return result
+        except sqlite3.Error as err:
+            print(f'Error writing to {self.filename}: {err}', file=sys.stderr)
+            return None
+    def write(self, statements):
+        if self.writer is None:
+            self.writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'sqlite-writer')
+        return self.writer.submit(self.run_write, statements)
+    def close_write_connection(self):
+        if self.write_connection is not None:
+            self.write_connection.close()
+            self.write_connection = None
+    def event_key(event):
+        return (event.guild_id, event.channel_id, event.message_id)
+    def event_row(event):
+        return (event.guild_id, event.channel_id, event.message_id, json.dumps(event.to_serializable()))
+    def migrate_json(self):
+        connection = self.connect()
+        if connection.execute('SELECT value FROM meta WHERE key = ?', (self.META_JSON_MIGRATED,)).fetchone() is not None:
+            return
+        if self.json_filename is None or not os.path.isfile(self.json_filename):
+            return
+        with open(self.json_filename, 'r') as data_file:
+            data_json = json.load(data_file)
+        rows = []
+        if data_json is not None and 'events' in data_json:
+            for event_list_json in data_json['events'].values():
+                for event_json in event_list_json:
+                    event = Event.from_deserializable(event_json)
+                    if event is not None:
+                        rows.append(SqliteEventStorage.event_row(event))
+        with connection:
+            connection.executemany(self.UPSERT_EVENT, rows)
+            connection.execute('INSERT INTO meta (key, value) VALUES (?, ?)', (self.META_JSON_MIGRATED, self.json_filename))
+        print(f'Migrated {len(rows)} event(s) from {self.json_filename} to {self.filename}')
+    def load(self):
+        self.migrate_json()
+    def load_guild(self, guild_id):
+        events = {}
+        for (data,) in self.connect().execute('SELECT data FROM events WHERE guild_id = ? ORDER BY rowid', (guild_id,)):
+            event = Event.from_deserializable(json.loads(data))
+            if event is not None:
+                id_str = Event.format_room_id(event.guild_id, event.channel_id)
+                events.setdefault(id_str, []).append(event)
+        return events
+    def stop_writer(self):
+        # waits for the pending writes
+        if self.writer is not None:
+            self.writer.submit(self.close_write_connection)
+            self.writer.shutdown(wait = True)
+            self.writer = None
+    def disconnect(self):
+        self.stop_writer()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+    async def close(self):
+        await asyncio.to_thread(self.stop_writer)
+        self.disconnect()
+    def stored_rooms(self):
+        return list(self.connect().execute('SELECT DISTINCT guild_id, channel_id FROM events'))
+    async def claim_reminder(self, event, days_remaining):
+        today = datetime.date.today().isoformat()
+        def claim(connection):
+            if self.pruned_date != today:
+                connection.execute('DELETE FROM reminders WHERE reminder_date < ?', (today,))
+                self.pruned_date = today
+            # only the first process to insert the reminder row sends it
+            cursor = connection.execute('INSERT OR IGNORE INTO reminders (message_id, reminder_date, days_remaining) VALUES (?, ?, ?)',
+                (event.message_id, today, days_remaining))
+            return cursor.rowcount == 1
+        return bool(await asyncio.wrap_future(self.write(claim)))
+    def events_added(self, events):
+        if len(events) > 0:
+            rows = [SqliteEventStorage.event_row(event) for event in events]
+            self.write(lambda connection: connection.executemany(self.UPSERT_EVENT, rows))
+    def event_updated(self, event):
+        row = SqliteEventStorage.event_row(event)
+        self.write(lambda connection: connection.execute(self.UPSERT_EVENT, row))
+    def events_removed(self, events):
+        if len(events) > 0:
+            keys = [SqliteEventStorage.event_key(event) for event in events]
+            self.write(lambda connection: connection.executemany(self.DELETE_EVENT, keys))
+    def events_changed(self, updated_events, removed_events):
+        if len(updated_events) + len(removed_events) > 0:
+            rows = [SqliteEventStorage.event_row(event) for event in updated_events]
+            keys = [SqliteEventStorage.event_key(event) for event in removed_events]
+            def change(connection):
+                connection.executemany(self.UPSERT_EVENT, rows)
+                connection.executemany(self.DELETE_EVENT, keys)
+            self.write(change)
+    def channel_cleared(self, guild_id, channel_id):
+        self.write(lambda connection: connection.execute('DELETE FROM events WHERE guild_id = ? AND channel_id = ?', (guild_id, channel_id)))
+
 class Tobman:
+    DEFAULT_REFRESH_CONCURRENCY = 5
+    DEFAULT_REMINDER_CONCURRENCY = 10
+    REMINDER_FIELDS_PER_EMBED = 25
+    REMINDER_FIELD_VALUE_LIMIT = 1024
+    # event messages fetched less than this many seconds ago are not refreshed when listing events
+    LIST_REFRESH_MAX_AGE = 300
+    # messages of history read per channel when reconciling the events at startup
+    RECONCILE_HISTORY_LIMIT = 2000
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.rename_allowed_in = []
         self.events_allowed_in = []
         self.events = {}
+        self.events_by_message_id = {}
+        self.loaded_guilds = set()
+        self.metrics = Metrics()
+        self.rate_limiter = RateLimiter(self.metrics)
+        self.notifications = NotificationQueue(self)
+        self.reaction_debouncer = ReactionDebouncer(self)
+        self.calendar_feed = CalendarFeed(self)
+        self.event_list_pages = EventListPages(self)
+        self.title_index = TitleIndex(self)
+        # room id -> background refresh task
+        self.refresh_tasks = {}
+        self.reconcile_task = None
+        # room id -> lock held while the events of the channel are changed across awaits
+        self.channel_locks = collections.defaultdict(asyncio.Lock)
+        self.section_permissions = SectionPermissions(self)
+        self.web_server = TobmanWebServer()
+        self.web_server.add_route('GET', r'/calendar/{guild_id:\d+}/{channel_id:\d+}.ics', self.calendar_feed.handle_request)
+        self.web_server.add_route('GET', '/metrics', self.metrics.handle_request)
+        self.refresh_concurrency = self.DEFAULT_REFRESH_CONCURRENCY
+        self.reminder_concurrency = self.DEFAULT_REMINDER_CONCURRENCY
         self.config_filename = CONFIG_FILENAME
-        self.data_filename = DATA_JSON_FILENAME
+        self.config_watcher = ConfigWatcher(self)
         self.remove_rename_commands = False
         self.remove_event_commands = False
+        self.sync_app_commands = False
+        self.storage = JsonEventStorage(self, DATA_JSON_FILENAME)
         self.init_schedule()
-    def load_config(self):
+    def read_config(self):
         with open(self.config_filename, 'r') as config_file:
             data = yaml.safe_load(config_file)
-            if 'discord_api_token' not in data:
-                print(f'Error: {self.config_filename} does not define the key "token"')
-            self.token = data['discord_api_token']
-            if 'rename_allowed_in' in data:
-                self.rename_allowed_in = [Section.from_string(section_string) for section_string in data['rename_allowed_in']]
-            if 'events_allowed_in' in data:
-                self.events_allowed_in = [Section.from_string(section_string) for section_string in data['events_allowed_in']]
-            if 'remove_rename_commands' in data:
-                self.remove_rename_commands = bool(data['remove_rename_commands'])
-            if 'remove_event_commands' in data:
-                self.remove_event_commands = bool(data['remove_event_commands'])
+        if not isinstance(data, dict):
+            raise ValueError(f'{self.config_filename} does not contain a mapping')
+        if 'discord_api_token' not in data:
+            raise ValueError(f'{self.config_filename} does not define the key "discord_api_token"')
+        return data
+    def parse_live_config(self, data):
+        # the settings that can be changed while running, with their defaults when missing
+        live_config = {}
+        for key in ['rename_allowed_in', 'events_allowed_in']:
+            section_strings = data.get(key) or []
+            if not isinstance(section_strings, list):
+                raise ValueError(f'{key} must be a list of sections')
+            live_config[key] = [Section.from_string(str(section_string)) for section_string in section_strings]
+        for key in ['remove_rename_commands', 'remove_event_commands']:
+            live_config[key] = bool(data.get(key, False))
+        live_config['reaction_debounce_seconds'] = float(data.get('reaction_debounce_seconds', ReactionDebouncer.DEFAULT_WINDOW))
+        live_config['refresh_concurrency'] = max(1, int(data.get('refresh_concurrency', self.DEFAULT_REFRESH_CONCURRENCY)))
+        live_config['reminder_concurrency'] = max(1, int(data.get('reminder_concurrency', self.DEFAULT_REMINDER_CONCURRENCY)))
+        return live_config
+    def apply_live_config(self, live_config):
+        # plain assignments without any await, handlers never see half of a configuration
+        self.rename_allowed_in = live_config['rename_allowed_in']
+        self.events_allowed_in = live_config['events_allowed_in']
+        self.remove_rename_commands = live_config['remove_rename_commands']
+        self.remove_event_commands = live_config['remove_event_commands']
+        self.reaction_debouncer.window = live_config['reaction_debounce_seconds']
+        self.refresh_concurrency = live_config['refresh_concurrency']
+        self.reminder_concurrency = live_config['reminder_concurrency']
+        self.section_permissions.clear()
+    def reload_config(self):
+        try:
+            live_config = self.parse_live_config(self.read_config())
+        except Exception as err:
+            print(f'Error reloading {self.config_filename}, keeping the current configuration: {err}', file=sys.stderr)
+            return False
+        self.apply_live_config(live_config)
+        print(f'Reloaded {self.config_filename}')
+        return True
+    def load_config(self):
+        data = self.read_config()
+        self.token = data['discord_api_token']
+        self.apply_live_config(self.parse_live_config(data))
+        self.sync_app_commands = bool(data.get('sync_app_commands', False))
+        if 'config_reload_interval' in data:
+            self.config_watcher.interval = float(data['config_reload_interval'])
+        if 'http_port' in data:
+            self.web_server.port = int(data['http_port'])
+        if 'http_host' in data:
+            self.web_server.host = str(data['http_host'])
+        if 'shard_count' in data:
+            self.bot.shard_count = int(data['shard_count'])
+        if 'shard_ids' in data:
+            self.bot.shard_ids = [int(shard_id) for shard_id in data['shard_ids']]
+        storage_type = data.get('data_storage', 'json')
+        if storage_type == 'sqlite':
+            self.storage = SqliteEventStorage(self, data.get('data_sqlite_filename', DATA_SQLITE_FILENAME), DATA_JSON_FILENAME)
+        else:
+            if storage_type not in ('json', 'snapshot'):
+                print(f'Error: unknown data_storage "{storage_type}" in {self.config_filename}, using json', file=sys.stderr)
+            journal = None
+            if data.get('data_journal'):
+                journal = EventJournal(data.get('data_journal_filename', DATA_JOURNAL_FILENAME),
+                    int(data.get('data_journal_compact_every', EventJournal.DEFAULT_COMPACT_THRESHOLD)))
+            save_interval = float(data.get('data_save_interval', DataPersister.DEFAULT_INTERVAL))
+            if storage_type == 'snapshot':
+                self.storage = SnapshotEventStorage(self, data.get('data_snapshot_filename', DATA_SNAPSHOT_FILENAME), DATA_JSON_FILENAME, journal, save_interval)
+            else:
+                self.storage = JsonEventStorage(self, DATA_JSON_FILENAME, journal, save_interval)
     def load_data(self):
-        import os.path
-        if os.path.isfile(self.data_filename):
-            with open(self.data_filename, 'r') as data_file:
-                data_json = json.load(data_file)
-                if data_json is not None:
-                    if 'events' in data_json:
-                        self.events = {}
-                        for channel_id_key, event_list_json in data_json['events'].items():
-                            self.events[channel_id_key] = []
-                            for event_json in event_list_json:
-                                event = Event.from_deserializable(event_json)
-                                print(f'Deserialized event {event.title}')
-                                if event is not None:
-                                    self.events[channel_id_key].append(event)
-                                    print(f'Added event {event.title} to {channel_id_key}')
-    def save_data(self):
-        data_json = {}
-        data_json['events'] = {}
-        for channel_id_key, event_list in self.events.items():
-            event_list_json = []
-            if event_list is not None:
-                for event in event_list:
-                    event_list_json.append(event.to_serializable())
-                data_json['events'][str(channel_id_key)] = event_list_json
-        with open(self.data_filename, 'w') as data_file:
-            json.dump(data_json, data_file)
+        self.storage.load()
+    def load_guild(self, guild_id):
+        if guild_id in self.loaded_guilds:
+            return
+        self.loaded_guilds.add(guild_id)
+        event_count = 0
+        for id_str, event_list in self.storage.load_guild(guild_id).items():
+            self.events[id_str] = event_list
+            for event in event_list or []:
+                self.events_by_message_id[event.message_id] = event
+                self.title_index.add(event)
+                self.schedule.schedule_event(event)
+                event_count += 1
+        print(f'Loaded {event_count} event(s) for guild {guild_id}')
+    async def flush_data(self):
+        await self.storage.close()
+    async def shutdown(self):
+        self.config_watcher.stop()
+        # the background passes are done again later, the events are only changed under the channel locks
+        background_tasks = [task for task in [self.reconcile_task, *self.refresh_tasks.values()] if task is not None]
+        for task in background_tasks:
+            task.cancel()
+        await self.web_server.stop()
+        # nothing may change the events once the storage is closed
+        await self.reaction_debouncer.stop()
+        await asyncio.gather(*background_tasks, return_exceptions = True)
+        await self.notifications.drain()
+        await self.flush_data()
     def add_event(self, event):
-        if (event.guild_id is not None) and (event.channel_id is not None) and (event.message_id is not None):
-            id_str = Event.format_room_id(event.guild_id, event.channel_id)
-            if self.events.get(id_str) is None:
-                self.events[id_str] = []
-            self.events[id_str].append(event)
-            self.save_data()
+        self.add_events([event])
+    def add_events(self, events):
+        added_events = []
+        for event in events:
+            if (event.guild_id is not None) and (event.channel_id is not None) and (event.message_id is not None):
+                self.load_guild(event.guild_id)
+                id_str = Event.format_room_id(event.guild_id, event.channel_id)
+                if self.events.get(id_str) is None:
+                    self.events[id_str] = []
+                self.events[id_str].append(event)
+                self.events_by_message_id[event.message_id] = event
+                self.title_index.add(event)
+                self.schedule.schedule_event(event)
+                self.calendar_feed.invalidate(event.guild_id, event.channel_id)
+                self.event_list_pages.invalidate(event.guild_id, event.channel_id)
+                added_events.append(event)
+        # a single storage write for the whole batch
+        self.storage.events_added(added_events)
+    async def send_message(self, channel, *args, **kwargs):
+        await self.rate_limiter.acquire(RateLimiter.SEND_MESSAGE, channel.id)
+        return await channel.send(*args, **kwargs)
+    async def add_reaction(self, message, emoji):
+        await self.rate_limiter.acquire(RateLimiter.ADD_REACTION, message.channel.id)
+        await message.add_reaction(emoji)
+    async def delete_message(self, message):
+        await self.rate_limiter.acquire(RateLimiter.DELETE_MESSAGE, message.channel.id)
+        await message.delete()
+    async def import_events(self, channel, command_message, events):
+        # messages then reactions go out one at a time, paced by the rate limiter buckets of the channel
+        sent_events = []
+        for event in events:
+            if not event.still_active():
+                continue
+            event.original_user_id = command_message.author.id
+            embed = await event.generate_discord_embed()
+            try:
+                message = await self.send_message(channel, embed = embed)
+            except discord.HTTPException as err:
+                print(f'Error sending imported event {event.title}: {err}', file=sys.stderr)
+                break
+            event.set_ids(channel.guild.id, channel.id, message.id, command_message.id)
+            event.ok_user_ids = set()
+            event.ng_user_ids = set()
+            # the message already shows this embed, later refreshes do not need to edit it
+            event.embed_digest = Event.digest_embed(embed)
+            sent_events.append((event, message))
+        self.add_events([event for event, message in sent_events])
+        for event, message in sent_events:
+            for emoji in Event.REACTIONS:
+                try:
+                    await self.add_reaction(message, emoji)
+                except discord.HTTPException as err:
+                    print(f'Error adding reaction to imported event {event.title}: {err}', file=sys.stderr)
+        print(f'Imported {len(sent_events)} event(s) in channel {Event.format_room_id(channel.guild.id, channel.id)}')
+        return [event for event, message in sent_events]
+    def update_event(self, event):
+        # a deleted event is not stored again by a refresh that was still running
+        if not self.has_event(event):
+            return
+        self.schedule.schedule_event(event)
+        self.title_index.update(event)
+        self.calendar_feed.invalidate(event.guild_id, event.channel_id)
+        self.event_list_pages.invalidate(event.guild_id, event.channel_id)
+        self.storage.event_updated(event)
     def clear_events(self, guild_id, channel_id):
+        self.load_guild(guild_id)
         id_str = Event.format_room_id(guild_id, channel_id)
         event_list = self.events.get(id_str)
         self.events[id_str] = None
-        self.save_data()
+        if event_list:
+            for event in event_list:
+                self.events_by_message_id.pop(event.message_id, None)
+                self.schedule.unschedule_event(event)
+                self.calendar_feed.forget_event(event)
+        self.title_index.clear(guild_id, channel_id)
+        self.calendar_feed.invalidate(guild_id, channel_id)
+        self.event_list_pages.invalidate(guild_id, channel_id)
+        self.storage.channel_cleared(guild_id, channel_id)
         return event_list
+    def remove_events(self, event_list, events, persist = True):
+        for event in events:
+            event_list.remove(event)
+            self.events_by_message_id.pop(event.message_id, None)
+            self.title_index.remove(event)
+            self.schedule.unschedule_event(event)
+            self.calendar_feed.forget_event(event)
+            self.event_list_pages.invalidate(event.guild_id, event.channel_id)
+        if persist:
+            self.storage.events_removed(events)
+    def truncate_field_value(value, limit = REMINDER_FIELD_VALUE_LIMIT):
+        if len(value) <= limit:
+            return value
+        # whole lines of mentions are dropped first, the event link is only cut when it is too long by itself
+        cut = value.rfind('\n', 0, limit - 1)
+        if cut > 0:
+            return value[:cut] + '\n…'
+        return value[:limit - 1] + '…'
+    def has_event(self, event):
+        return self.events_by_message_id.get(event.message_id) is event
+    def channel_lock(self, guild_id, channel_id):
+        # changes within a channel are serialized, different channels proceed in parallel
+        return self.channel_locks[Event.format_room_id(guild_id, channel_id)]
     def get_event(self, guild_id, channel_id, message_id):
+        event = self.events_by_message_id.get(message_id)
+        if (event is not None) and (event.guild_id == guild_id) and (event.channel_id == channel_id):
+            return [event]
+        return []
+    def find_events(self, guild_id, channel_id, event_title, message_id = None):
+        # a message id picks a single event, a title all the events that have it
+        if message_id is not None:
+            return self.get_event(guild_id, channel_id, message_id)
+        return self.title_index.find(guild_id, channel_id, event_title)
+    def delete_events(self, guild_id, channel_id, event_title, message_id = None):
         id_str = Event.format_room_id(guild_id, channel_id)
         event_list = self.events.get(id_str)
-        if event_list:
-            return [event for event in event_list if (event.message_id == message_id)]
-    def get_events_by_title(self, guild_id, channel_id, event_title):
-        id_str = Event.format_room_id(guild_id, channel_id)
-        event_list = self.events.get(id_str)
-        for event in event_list:
-            if event.title.strip() == event_title.strip():
-                yield event
-    def delete_events(self, guild_id, channel_id, event_title):
-        id_str = Event.format_room_id(guild_id, channel_id)
-        event_list = self.events.get(id_str)
-        deleted_events = []
-        for event in event_list:
-            if event.title == event_title:
-                deleted_events.append(event)
+        deleted_events = self.find_events(guild_id, channel_id, event_title, message_id)
         for event in deleted_events:
-            event_list.remove(event)
             print(f'Removed event {event.title} from {id_str}')
-            yield event
-    async def refresh_channel_events(self, channel):
-        if Section.list_fits(bot.tobman.events_allowed_in, channel):
+        self.remove_events(event_list, deleted_events)
+        yield from deleted_events
+    def refresh_channel_in_background(self, channel):
+        id_str = Event.format_room_id(channel.guild.id, channel.id)
+        if id_str not in self.refresh_tasks:
+            task = self.refresh_tasks[id_str] = asyncio.create_task(self.refresh_channel_events(channel, self.LIST_REFRESH_MAX_AGE))
+            task.add_done_callback(lambda task: self.refresh_tasks.pop(id_str, None))
+    async def refresh_channel_events(self, channel, max_age = None):
+        if self.channel_allows(channel, SectionPermissions.EVENTS):
             guild = channel.guild
             id_str = Event.format_room_id(guild.id, channel.id)
-            event_list = self.events.get(id_str)
-            if event_list is not None:
+            # the lock is only held to change the event list, commands in the channel do not wait for the fetches and edits
+            async with self.channel_lock(guild.id, channel.id):
+                event_list = self.events.get(id_str)
+                if event_list is None:
+                    return
                 print(f'Refreshing event list for {id_str}')
-                events_to_delete = []
-                for event in event_list:
-                    if event.still_active():
-                        try:
-                            await event.refresh_message(channel)
-                        except discord.NotFound:
-                            print(f'Message {event.message_id} not found, deleting event {event.title}', file=sys.stderr)
-                            events_to_delete.append(event)
-                        except Exception as err:
-                            print(f'Error refreshing events for message {event.message_id}: {err}', file=sys.stderr)
-                    else:
-                        events_to_delete.append(event)
-                for event in events_to_delete:
-                    print(f'Removed event {event.title} from {id_str}')
-                    event_list.remove(event)
-                self.save_data()
+                active_events = [event for event in event_list if event.still_active()]
+                if max_age is not None:
+                    now = time.time()
+                    active_events = [event for event in active_events if (event.refreshed_at is None) or (now - event.refreshed_at > max_age)]
+                self.remove_refreshed_events(id_str, [event for event in event_list if not event.still_active()])
+            missing_events = await self.refresh_events(channel, active_events)
+            async with self.channel_lock(guild.id, channel.id):
+                self.remove_refreshed_events(id_str, missing_events)
+    def remove_refreshed_events(self, id_str, events):
+        # events deleted or cleared by a command during the refresh are already gone
+        events = [event for event in events if self.has_event(event)]
+        for event in events:
+            print(f'Removed event {event.title} from {id_str}')
+        if len(events) > 0:
+            self.remove_events(self.events[id_str], events)
+    async def refresh_events(self, channel, events):
+        missing_events = []
+        semaphore = asyncio.Semaphore(self.refresh_concurrency)
+        async def refresh(event):
+            async with semaphore:
+                try:
+                    await event.refresh_message(channel)
+                except discord.NotFound:
+                    print(f'Message {event.message_id} not found, deleting event {event.title}', file=sys.stderr)
+                    missing_events.append(event)
+                except Exception as err:
+                    print(f'Error refreshing events for message {event.message_id}: {err}', file=sys.stderr)
+        await asyncio.gather(*[refresh(event) for event in events])
+        return missing_events
+    async def reconcile_events(self):
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.refresh_concurrency)
+        updated_events = []
+        removed_events = []
+        async def reconcile(id_str):
+            guild_id, channel_id = Event.parse_room_id(id_str)
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                return
+            async with semaphore:
+                event_list = self.events.get(id_str)
+                if not event_list:
+                    return
+                try:
+                    updated, missing = await self.reconcile_channel(channel, list(event_list))
+                except Exception as err:
+                    print(f'Error reconciling events of {id_str}: {err}', file=sys.stderr)
+                    return
+            async with self.channel_lock(guild_id, channel_id):
+                # events deleted by a command while the history was read are already gone
+                missing = [event for event in missing if self.has_event(event)]
+                event_list = self.events.get(id_str)
+                for event in missing:
+                    print(f'Message {event.message_id} not found, deleting event {event.title}', file=sys.stderr)
+                self.remove_events(event_list, missing, persist = False)
+                for event in updated:
+                    self.event_list_pages.invalidate(event.guild_id, event.channel_id)
+            updated_events.extend(updated)
+            removed_events.extend(missing)
+        await asyncio.gather(*[reconcile(id_str) for id_str, event_list in list(self.events.items()) if event_list])
+        # a single storage write for the whole pass, without the events deleted in the meantime
+        self.storage.events_changed([event for event in updated_events if self.has_event(event)], removed_events)
+        print(f'Reconciled events in {time.perf_counter() - started:.1f}s: {len(updated_events)} roster(s) updated, {len(removed_events)} event(s) removed')
+    async def reconcile_channel(self, channel, events):
+        wanted = { event.message_id: event for event in events }
+        messages = {}
+        scanned_count = 0
+        last_message_id = None
+        # the event messages are read by pages of history from the oldest one, instead of one fetch per event
+        async for message in channel.history(limit = self.RECONCILE_HISTORY_LIMIT, after = discord.Object(id = min(wanted) - 1), oldest_first = True):
+            scanned_count += 1
+            last_message_id = message.id
+            if message.id in wanted:
+                messages[message.id] = message
+                if len(messages) == len(wanted):
+                    break
+        if (len(messages) == len(wanted)) or (scanned_count < self.RECONCILE_HISTORY_LIMIT):
+            unscanned_events = []
+        else:
+            unscanned_events = [event for event in events if event.message_id > last_message_id]
+        missing_events = [event for event in events if (event.message_id not in messages) and (event not in unscanned_events)]
+        updated_events = []
+        for message in messages.values():
+            event = wanted[message.id]
+            event.ok_count, event.ng_count = Event.reaction_counts(message)
+            event.refreshed_at = time.time()
+            if not event.roster_matches(message):
+                await event.build_roster(message)
+                updated_events.append(event)
+        # events past the scanned history are fetched one at a time, like a refresh
+        missing_events += await self.refresh_events(channel, unscanned_events)
+        return updated_events, missing_events
+    def owns_guild(self, guild_id):
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if (shard_ids is None) or (not self.bot.shard_count):
+            return True
+        return guild_shard_id(guild_id, self.bot.shard_count) in shard_ids
+    def channel_allows(self, channel, permission):
+        return self.section_permissions.allows(channel, permission)
     def get_channel_from_ids(self, guild_id, channel_id, only_if_can_send = False):
         channel = self.bot.get_channel(channel_id)
         if channel and ((not only_if_can_send) or channel.permissions_for(channel.guild.me).send_messages):
             return channel
         return None
     async def on_event_message_delete(self, guild_id, channel_id, message_id):
-        id_str = Event.format_room_id(guild_id, channel_id)
-        event_list = self.events.get(id_str)
-        if event_list:
-            indices_to_remove = []
-            events_to_delete = [event for event in event_list if event.message_id == message_id]
-            if len(events_to_delete) > 0:
-                for event in events_to_delete:
-                    event_list.remove(event)
-                self.save_data()
+        if message_id not in self.events_by_message_id:
+            return
+        async with self.channel_lock(guild_id, channel_id):
+            event_list = self.events.get(Event.format_room_id(guild_id, channel_id))
+            events_to_delete = self.get_event(guild_id, channel_id, message_id)
+            if event_list and (len(events_to_delete) > 0):
+                self.remove_events(event_list, events_to_delete)
                 channel = self.get_channel_from_ids(guild_id, channel_id, only_if_can_send = True)
                 if channel:
                     for event in events_to_delete:
                         embed = discord.Embed(title = Translation.EVENTS_DELETE_TITLE, description = Translation.EVENTS_DELETE_DESC.format(event.title))
-                        await channel.send(embed = embed)
+                        self.notifications.notify(channel, embed)
     async def on_event_reaction_add(self, guild_id, channel_id, message_id, user_id, emoji):
+        if message_id not in self.events_by_message_id:
+            return
         if user_id != self.bot.user.id and emoji.name in Event.REACTIONS:
-            channel = self.get_channel_from_ids(guild_id, channel_id, only_if_can_send = True)
-            if channel:
-                for event in self.get_event(guild_id, channel_id, message_id):
-                    await event.refresh_message(channel)
-                    member = bot.get_guild(guild_id).get_member(user_id)
-                    if member:
-                        desc_message = None
-                        if emoji.name == Event.REACTION_OK:
-                            desc_message = Translation.EVENTS_REACT_OK
-                        elif emoji.name == Event.REACTION_NG:
-                            desc_message = Translation.EVENTS_REACT_NG
-                        embed = discord.Embed(
-                            title = Translation.EVENTS_REACT_TITLE.format(event.title),
-                            description = desc_message.format(member.mention, event.title, event.message_url())
-                        )
-                        await channel.send(embed = embed)
+            for event in self.get_event(guild_id, channel_id, message_id):
+                self.reaction_debouncer.add(event, user_id, emoji.name == Event.REACTION_OK)
+                if event.roster_add(emoji.name, user_id):
+                    self.update_event(event)
     async def on_event_reaction_remove(self, guild_id, channel_id, message_id, user_id, emoji):
+        if message_id not in self.events_by_message_id:
+            return
         if user_id != self.bot.user.id and emoji.name in Event.REACTIONS:
-            channel = self.get_channel_from_ids(guild_id, channel_id, only_if_can_send = True)
-            if channel:
-                for event in self.get_event(guild_id, channel_id, message_id):
-                    # if there are no more reactions of this emoji then add it back
-                    await event.refresh_message(channel)
-                    if emoji.name == Event.REACTION_OK:
-                        member = bot.get_guild(guild_id).get_member(user_id)
-                        embed = discord.Embed(
-                            title = Translation.EVENTS_REACT_TITLE.format(event.title),
-                            description = Translation.EVENTS_REACT_NG.format(member.mention, event.title, event.message_url())
-                        )
-                        await channel.send(embed = embed)
+            for event in self.get_event(guild_id, channel_id, message_id):
+                # removing a NG reaction only needs the embed to be refreshed
+                joined = False if emoji.name == Event.REACTION_OK else None
+                self.reaction_debouncer.add(event, user_id, joined)
+                if event.roster_remove(emoji.name, user_id):
+                    self.update_event(event)
+    async def flush_event_reactions(self, pending):
+        event = pending.event
+        # the event may have been deleted since the reactions were queued
+        if not self.has_event(event):
+            return
+        channel = self.get_channel_from_ids(event.guild_id, event.channel_id, only_if_can_send = True)
+        if not channel:
+            return
+        try:
+            await event.refresh_message(channel)
+        except discord.NotFound:
+            print(f'Message {event.message_id} not found while handling reactions on {event.title}', file=sys.stderr)
+            return
+        if not self.has_event(event):
+            return
+        joined_ids, left_ids = pending.changes()
+        description_lines = []
+        for user_ids, singular_message, plural_message in [
+            (joined_ids, Translation.EVENTS_REACT_OK, Translation.EVENTS_REACT_OK_PLURAL),
+            (left_ids, Translation.EVENTS_REACT_NG, Translation.EVENTS_REACT_NG_PLURAL)]:
+            if len(user_ids) > 0:
+                desc_message = singular_message if len(user_ids) == 1 else plural_message
+                mentions = ', '.join(f'<@{user_id}>' for user_id in user_ids)
+                description_lines.append(desc_message.format(mentions, event.title, event.message_url()))
+        if len(description_lines) > 0:
+            embed = discord.Embed(
+                title = Translation.EVENTS_REACT_TITLE.format(event.title),
+                description = '\n'.join(description_lines)
+            )
+            self.notifications.notify(channel, embed)
     # time of day for reminders
     SCHEDULE_TIME = datetime.time(hour=9)
     EVENT_DAYS = [
@@ -558,85 +2202,234 @@ class Tobman:
     ]
     def init_schedule(self):
         self.schedule = TobmanTimeScheduleCog(self)
-        now = datetime.datetime.now()
-        self.next_schedule = datetime.datetime.combine(datetime.datetime.today(), self.SCHEDULE_TIME)
-        if now > self.next_schedule:
-            self.next_schedule += datetime.timedelta(days=1)
-    async def events_scheduled_job(self):
-        await self.bot.wait_until_ready()
-        if not self.bot.is_closed():
-            now = datetime.datetime.now()
-            if (now >= self.next_schedule):
-                print(f'Running scheduled events check')
-                self.last_schedule = now
-                self.next_schedule = datetime.datetime.combine(datetime.datetime.today() + datetime.timedelta(days=1), self.SCHEDULE_TIME)
-                print(f'Next schedule: {self.next_schedule}')
-                for channel_id_key, event_list in self.events.items():
-                    guild_id, channel_id = Event.parse_room_id(channel_id_key)
-                    if guild_id and channel_id:
-                        channel = self.bot.get_channel(channel_id)
-                        if channel:
-                            for days_remaining, event_date_message in self.EVENT_DAYS:
-                                events_to_come = []
-                                for event in event_list:
-                                    try:
-                                        await event.refresh_message(channel)
-                                        if event.remaining_days() == days_remaining:
-                                            events_to_come.append(event)
-                                            print(f'Event in {days_remaining} day(s) [{event_date_message}]: "{event.title}"')
-                                    except discord.NotFound:
-                                        print(f'Message {event.message_id} ({event.title}) not found, ignoring for scheduled check', file=sys.stderr)
-                                if len(events_to_come) > 0:
-                                        embed = discord.Embed(title = Translation.EVENTS_REMINDER_TITLE,
-                                            type = 'rich'
-                                        )
-                                        for event in events_to_come:
-                                            ok_mentions = [user.mention for user in await event.ok_users()]
-                                            ok_mentions_string = '\n'.join(ok_mentions)
-                                            if len(ok_mentions_string) > 0:
-                                                ok_mentions_string = '\n' + ok_mentions_string
-                                            embed.add_field(name = f'{event_date_message}', value = f'[{event.title}]({event.message_url()}){ok_mentions_string}')
-                                        await channel.send(embed = embed)
-                        else:
-                            print(f'Channel not found: {channel_id} {len(event_list)}', file=sys.stderr)
+    async def events_scheduled_job(self, due_reminders):
+        print(f'Running scheduled events check for {len(due_reminders)} reminder(s)')
+        started = time.perf_counter()
+        reminders_by_channel = {}
+        for event, days_remaining in due_reminders:
+            reminders_by_channel.setdefault((event.guild_id, event.channel_id), []).append((event, days_remaining))
+        # channel id -> seconds between the start of the job and the reminder being sent
+        channel_lags = {}
+        channel_queue = collections.deque(reminders_by_channel.items())
+        async def reminder_worker():
+            while channel_queue:
+                (guild_id, channel_id), reminders = channel_queue.popleft()
+                try:
+                    if await self.send_channel_reminders(guild_id, channel_id, reminders):
+                        channel_lags[channel_id] = time.perf_counter() - started
+                        self.metrics.observe(Metrics.REMINDER_CHANNEL_LAG, channel_lags[channel_id])
+                except Exception as err:
+                    print(f'Error sending reminders to channel {channel_id}: {err}', file=sys.stderr)
+        await asyncio.gather(*[reminder_worker() for worker_index in range(min(self.reminder_concurrency, len(reminders_by_channel)))])
+        duration = time.perf_counter() - started
+        self.metrics.observe(Metrics.REMINDER_DISPATCH, duration)
+        if len(channel_lags) > 0:
+            lags = sorted(channel_lags.values())
+            print(f'Reminders sent to {len(lags)} channel(s) in {duration:.2f}s, channel lag median {lags[len(lags) // 2]:.2f}s, max {lags[-1]:.2f}s')
+        return duration, channel_lags
+    async def send_channel_reminders(self, guild_id, channel_id, reminders):
+        channel = self.bot.get_channel(channel_id)
+        if not channel:
+            print(f'Channel not found: {channel_id} {len(reminders)}', file=sys.stderr)
+            return False
+        events_to_come = []
+        # the event list is not changed here, the claims and fetches do not hold the channel lock
+        for days_remaining, event_date_message in self.EVENT_DAYS:
+            for event, event_days_remaining in reminders:
+                if event_days_remaining != days_remaining:
+                    continue
+                # deleted since the reminder was scheduled
+                if not self.has_event(event):
+                    continue
+                if (not self.owns_guild(guild_id)) or (not await self.storage.claim_reminder(event, days_remaining)):
+                    print(f'Reminder for "{event.title}" in {days_remaining} day(s) handled by another process')
+                    continue
+                try:
+                    await event.refresh_message(channel)
+                    if self.has_event(event) and (event.remaining_days() == days_remaining):
+                        events_to_come.append((event, event_date_message))
+                        print(f'Event in {days_remaining} day(s) [{event_date_message}]: "{event.title}"')
+                except discord.NotFound:
+                    print(f'Message {event.message_id} ({event.title}) not found, ignoring for scheduled check', file=sys.stderr)
+        if len(events_to_come) == 0:
+            return False
+        # one combined reminder, split into several embeds of the same message past the field or character limits
+        embed = None
+        for event, event_date_message in events_to_come:
+            ok_mentions_string = '\n'.join(event.ok_mentions())
+            if len(ok_mentions_string) > 0:
+                ok_mentions_string = '\n' + ok_mentions_string
+            field_name = f'{event_date_message}'
+            field_value = Tobman.truncate_field_value(f'[{event.title}]({event.message_url()}){ok_mentions_string}')
+            if (embed is not None) and ((len(embed.fields) >= self.REMINDER_FIELDS_PER_EMBED)
+                    or (len(embed) + len(field_name) + len(field_value) > NotificationQueue.MAX_EMBED_CHARACTERS)):
+                self.notifications.notify(channel, embed)
+                embed = None
+            if embed is None:
+                embed = discord.Embed(title = Translation.EVENTS_REMINDER_TITLE,
+                    type = 'rich'
+                )
+            embed.add_field(name = field_name, value = field_value)
+        self.notifications.notify(channel, embed)
+        await self.notifications.flush_channel(channel.id)
+        return True
 
 class TobmanTimeScheduleCog(commands.Cog):
+    # upper bound on a single sleep so that wall clock changes are caught up with
+    MAX_SLEEP_SECONDS = 3600.0
     def __init__(self, tobman):
         self.tobman = tobman
+        self.heap = []
+        self.scheduled = {}
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
 
     def cog_unload(self):
-        self.loop_time_check.cancel()
+        if self.task is not None:
+            self.task.cancel()
 
     def start(self):
-        self.loop_time_check.start()
+        if (self.task is None) or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.loop_time_check())
+
+    def reminder_time(self, event, days_remaining):
+        return datetime.datetime.combine(event.date.date() - datetime.timedelta(days = days_remaining), self.tobman.SCHEDULE_TIME)
+
+    def schedule_event(self, event, now = None):
+        current = self.scheduled.get(event.message_id)
+        if (current is not None) and (current[1] == event.date):
+            return
+        # older heap entries of this event are dropped when popped since their generation no longer matches
+        generation = next(self.counter)
+        self.scheduled[event.message_id] = (generation, event.date)
+        if event.date is None:
+            return
+        now = now or datetime.datetime.now()
+        earliest = self.heap[0][0] if self.heap else None
+        for days_remaining, event_date_message in self.tobman.EVENT_DAYS:
+            reminder_time = self.reminder_time(event, days_remaining)
+            if reminder_time >= now:
+                heapq.heappush(self.heap, (reminder_time, next(self.counter), event.message_id, generation, days_remaining))
+        if (self.wakeup is not None) and self.heap and ((earliest is None) or (self.heap[0][0] < earliest)):
+            self.wakeup.set()
+
+    def unschedule_event(self, event):
+        self.scheduled.pop(event.message_id, None)
+
+    def next_reminder_time(self):
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        due_reminders = []
+        while self.heap and (self.heap[0][0] <= now):
+            reminder_time, order, message_id, generation, days_remaining = heapq.heappop(self.heap)
+            current = self.scheduled.get(message_id)
+            event = self.tobman.events_by_message_id.get(message_id)
+            if (event is not None) and (current is not None) and (current[0] == generation):
+                due_reminders.append((event, days_remaining))
+                self.tobman.metrics.observe(Metrics.SCHEDULER_LAG, (now - reminder_time).total_seconds())
+        return due_reminders
 
-    @tasks.loop(minutes=1.0)
     async def loop_time_check(self):
-        await self.tobman.events_scheduled_job()
-        if self.tobman.bot.is_closed():
-            self.cog_unload()
-        
+        while not self.tobman.bot.is_closed():
+            self.wakeup.clear()
+            timeout = self.MAX_SLEEP_SECONDS
+            next_reminder_time = self.next_reminder_time()
+            if next_reminder_time is not None:
+                timeout = min(max((next_reminder_time - datetime.datetime.now()).total_seconds(), 0.0), self.MAX_SLEEP_SECONDS)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            due_reminders = self.pop_due(datetime.datetime.now())
+            if len(due_reminders) > 0:
+                try:
+                    await self.tobman.events_scheduled_job(due_reminders)
+                except Exception as err:
+                    print(f'Error running scheduled events check: {err}', file=sys.stderr)
+
 intents = discord.Intents(messages=True, guilds=True, reactions=True, message_content=True)
 
-bot = commands.Bot(command_prefix='/', intents=intents)
+class TobmanBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        self.tobman.metrics.instrument_http(self.http)
+        self.tobman.storage.start()
+        self.tobman.config_watcher.start()
+        await self.tobman.web_server.start()
+        if self.tobman.sync_app_commands:
+            synced_commands = await self.tree.sync()
+            print(f'Synced {len(synced_commands)} slash command(s)')
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        with self.tobman.metrics.timer(Metrics.COMMAND_DURATION, command = ctx.command.name):
+            await super().invoke(ctx)
+    async def close(self):
+        await self.tobman.shutdown()
+        await super().close()
+
+def guild_shard_id(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+def shard_ids_for_process(process_index, process_count, shard_count):
+    return [shard_id for shard_id in range(shard_count) if shard_id % process_count == process_index]
+
+def launch_shard_processes(process_count, shard_count, fake_gateway = False, http_port = None):
+    processes = []
+    for process_index in range(process_count):
+        shard_ids = shard_ids_for_process(process_index, process_count, shard_count)
+        command = [sys.executable, os.path.abspath(__file__), '--shard-count', str(shard_count), '--shard-ids', ','.join(str(shard_id) for shard_id in shard_ids)]
+        if fake_gateway:
+            command.append('--fake-gateway')
+        # each process serves the calendars of its own guilds and its own metrics, on the next port
+        if http_port is not None:
+            command += ['--http-port', str(http_port + process_index)]
+        print(f'Starting shard process {process_index} with shards {shard_ids} of {shard_count}')
+        processes.append(subprocess.Popen(command))
+    try:
+        return max(process.wait() for process in processes)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        return max(process.wait() for process in processes)
+
+bot = TobmanBot(command_prefix='/', intents=intents)
 bot.tobman = Tobman(bot)
-bot.tobman.load_config()
-bot.tobman.load_data()
 
 @bot.event
 async def on_ready():
     print(f'Now logged in as {bot.user.name} {bot.user.id}')
     bot.tobman.schedule.start()
+    # on_ready also fires after a reconnection, reactions may have been missed then too
+    if (bot.tobman.reconcile_task is None) or bot.tobman.reconcile_task.done():
+        bot.tobman.reconcile_task = asyncio.create_task(bot.tobman.reconcile_events())
 
 @bot.event
 async def on_guild_available(guild):
     print(f'Opened guild {guild}')
+    bot.tobman.load_guild(guild.id)
     if not guild.me.guild_permissions.manage_messages:
         print('Cannot manage messages')
     if not guild.me.guild_permissions.manage_nicknames:
         print('Cannot manage nicknames')
     await guild.me.edit(nick = bot.user.name)
 
+@bot.event
+async def on_guild_channel_create(channel):
+    bot.tobman.section_permissions.invalidate(channel)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    bot.tobman.section_permissions.invalidate(after)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    bot.tobman.section_permissions.invalidate(channel)
+
 @bot.command(name='rename')
 async def rename(ctx, member_id, to_name):
     guild = ctx.guild
@@ -653,52 +2446,95 @@ async def rename(ctx, member_id, to_name):
     if member_real_id is not None:
         member = await guild.fetch_member(member_real_id)
     print(f'Rename command: try {member_id} ({member}) -> {to_name}') 
-    if (guild is not None) and (author is not None) and Section.list_fits(bot.tobman.rename_allowed_in, channel):
+    if (guild is not None) and (author is not None) and bot.tobman.channel_allows(channel, SectionPermissions.RENAME):
         if (member is not None) and (not member.bot):
             original_name = member.nick or member.name
             print(f'Rename command: change {original_name} to {to_name}')
             await member.edit(nick = to_name)
             embed = discord.Embed(title = Translation.RENAME_TITLE, type = 'rich', description = Translation.RENAME_MESSAGE.format(author.mention, original_name, member.mention))
-            await channel.send(embed = embed)
+            await bot.tobman.send_message(channel, embed = embed)
         else:
             await author.send(Translation.UNABLE_RENAME_USER.format(member_id))
         if bot.tobman.remove_rename_commands:
-            await ctx.message.delete()
+            await bot.tobman.delete_message(ctx.message)
+
+@bot.command(name='tobman.reload')
+async def reload(ctx):
+    guild = ctx.guild
+    author = ctx.author
+    channel = ctx.message.channel
+    if (guild is not None) and (not author.bot) and author.guild_permissions.administrator:
+        if bot.tobman.reload_config():
+            description = Translation.CONFIG_RELOAD_DONE
+        else:
+            description = Translation.CONFIG_RELOAD_ERROR
+        embed = discord.Embed(title = Translation.CONFIG_RELOAD_TITLE, type = 'rich', description = description)
+        await bot.tobman.send_message(channel, embed = embed)
 
 @bot.command(name='event.new')
 async def event(ctx, *args):
     guild = ctx.guild
     author = ctx.author
     channel = ctx.message.channel
-    if (guild is not None) and (not author.bot) and Section.list_fits(bot.tobman.events_allowed_in, channel) and len(args) > 0:
+    if (guild is not None) and (not author.bot) and bot.tobman.channel_allows(channel, SectionPermissions.EVENTS) and len(args) > 0:
         event, error_type = Event.parse_new_command(ctx.message, args)
         if event:
             embed = await event.generate_discord_embed()
             ics_cal_file = event.generate_date_ics()
             if ics_cal_file:
                 ics_cal_file = discord.File(ics_cal_file, filename = Translation.EVENT_CALENDAR_FILENAME.format(str(event.title)))
-            message = await channel.send(embed = embed, file = ics_cal_file)
-            event.set_ids(guild.id, channel.id, message.id, ctx.message.id)
-            event.original_user_id = ctx.message.author.id
-            bot.tobman.add_event(event)
-            # default reactions
-            await message.add_reaction(Event.REACTION_OK)
-            await message.add_reaction(Event.REACTION_NG)
-            await event.set_message(message)
+            message = await bot.tobman.send_message(channel, embed = embed, file = ics_cal_file)
+            async with bot.tobman.channel_lock(guild.id, channel.id):
+                event.set_ids(guild.id, channel.id, message.id, ctx.message.id)
+                event.original_user_id = ctx.message.author.id
+                event.ok_user_ids = set()
+                event.ng_user_ids = set()
+                bot.tobman.add_event(event)
+                # default reactions
+                await bot.tobman.add_reaction(message, Event.REACTION_OK)
+                await bot.tobman.add_reaction(message, Event.REACTION_NG)
+                await event.set_message(message)
             if bot.tobman.remove_event_commands:
-                await ctx.message.delete()
+                await bot.tobman.delete_message(ctx.message)
         elif error_type == EventError.DATE_ERROR:
             error_embed = discord.Embed(title = Translation.EVENTS_NEW_ERROR, type = 'rich', description = Translation.EVENTS_NEW_ERROR_DATE_FORMAT.format(arg, Event.DATE_FORMAT))
-            message = await channel.send(embed = error_embed)
+            message = await bot.tobman.send_message(channel, embed = error_embed)
         else:
-            message = await channel.send(EVENTS_NEW_ERROR)
+            message = await bot.tobman.send_message(channel, EVENTS_NEW_ERROR)
+
+@bot.command(name='event.import')
+async def event(ctx):
+    guild = ctx.guild
+    author = ctx.author
+    channel = ctx.message.channel
+    if (guild is not None) and (not author.bot) and bot.tobman.channel_allows(channel, SectionPermissions.EVENTS):
+        attachments = [attachment for attachment in ctx.message.attachments if attachment.filename.lower().endswith('.ics')]
+        if len(attachments) == 0:
+            embed = discord.Embed(title = Translation.EVENTS_IMPORT_TITLE, type = 'rich', description = Translation.EVENTS_IMPORT_NONE)
+            await bot.tobman.send_message(channel, embed = embed)
+            return
+        events = []
+        for attachment in attachments:
+            try:
+                ics_text = (await attachment.read()).decode('utf-8')
+                events.extend(await asyncio.to_thread(Event.from_ics_calendar, ics_text))
+            except Exception as err:
+                print(f'Error reading calendar {attachment.filename}: {err}', file=sys.stderr)
+                embed = discord.Embed(title = Translation.EVENTS_IMPORT_TITLE, type = 'rich', description = Translation.EVENTS_IMPORT_ERROR.format(attachment.filename))
+                await bot.tobman.send_message(channel, embed = embed)
+        imported_events = await bot.tobman.import_events(channel, ctx.message, events)
+        embed = discord.Embed(title = Translation.EVENTS_IMPORT_TITLE, type = 'rich', description = Translation.EVENTS_IMPORT_DESC.format(len(imported_events), channel.name))
+        embed.add_field(name = Translation.EVENTS_EDIT_BY, value = ctx.message.author.mention)
+        await bot.tobman.send_message(channel, embed = embed)
+        if bot.tobman.remove_event_commands:
+            await bot.tobman.delete_message(ctx.message)
 
 @bot.command(name='event.list')
 async def event(ctx):
     guild = ctx.guild
     author = ctx.author
     channel = ctx.message.channel
-    if (guild is not None) and (not author.bot) and Section.list_fits(bot.tobman.events_allowed_in, channel):
+    if (guild is not None) and (not author.bot) and bot.tobman.channel_allows(channel, SectionPermissions.EVENTS):
         id_str = Event.format_room_id(guild.id, channel.id)
         print(f'List events for channel {id_str}')
         event_list = bot.tobman.events.get(id_str)
@@ -707,104 +2543,173 @@ async def event(ctx):
                 type = 'rich',
                 description = Translation.EVENTS_LIST_NONE.format(channel.name)
             )
-            await channel.send(embed = embed)
+            await bot.tobman.send_message(channel, embed = embed)
         else:
-            await bot.tobman.refresh_channel_events(channel)
-            embed = discord.Embed(title = Translation.EVENTS_LIST_TITLE.format(channel.name),
+            # reply from the cached counts and rosters, stale messages are refreshed afterwards
+            page_index, page_count, embed = bot.tobman.event_list_pages.get_page(channel, 0)
+            if page_count > 1:
+                view = EventListView(bot.tobman.event_list_pages, channel)
+                view.update_buttons(page_count)
+                await bot.tobman.send_message(channel, embed = embed, view = view)
+            else:
+                await bot.tobman.send_message(channel, embed = embed)
+            bot.tobman.refresh_channel_in_background(channel)
+            if bot.tobman.remove_event_commands:
+                await bot.tobman.delete_message(ctx.message)
+
+async def edit_events_by_title(channel, author, event_title, args, message_id = None):
+    async with bot.tobman.channel_lock(channel.guild.id, channel.id):
+        edited_events = []
+        for event in bot.tobman.find_events(channel.guild.id, channel.id, event_title, message_id):
+            modifications = list(event.parse_edit_command(args))
+            error_count = 0
+            for modification, error in modifications:
+                if error:
+                    if error == EventError.DATE_ERROR:
+                        error_embed = discord.Embed(title = Translation.EVENTS_NEW_ERROR, type = 'rich', description = Translation.EVENTS_NEW_ERROR_DATE_FORMAT.format(arg, Event.DATE_FORMAT))
+                        message = await bot.tobman.send_message(channel, embed = error_embed)
+                    else:
+                        print(f'Error {error} while modifying event {event.title}, command: {args}', file=sys.stderr)
+                    error_count += 1
+            if (len(modifications) > 0) and (error_count == 0):
+                bot.tobman.update_event(event)
+                try:
+                    # Can't attach a file to a message edit...
+                    # ics_cal_file = discord.File(event.generate_date_ics(), filename = Translation.EVENT_CALENDAR_FILENAME.format(event.title))
+                    await event.refresh_message(channel)
+                except discord.NotFound:
+                    print(f'Message {event.message_id} not found, modifying event {event.title}', file=sys.stderr)
+                embed = discord.Embed(title = Translation.EVENTS_EDIT_TITLE,
+                    type = 'rich',
+                    description = Translation.EVENTS_EDIT_DESC.format(event.title, event.message_url())
+                )
+                embed.add_field(name = Translation.EVENTS_EDIT_BY, value = author.mention)
+                await event.generate_add_ok_ng_embed_fields(embed)
+                for modification, error in modifications:
+                    embed.add_field(name = Translation.EVENTS_MODIFICATION, value = str(modification))
+                bot.tobman.notifications.notify(channel, embed)
+            edited_events.append(event)
+        return edited_events
+
+async def delete_events_by_title(channel, author, event_title, message_id = None):
+    async with bot.tobman.channel_lock(channel.guild.id, channel.id):
+        event_list = list(bot.tobman.delete_events(channel.guild.id, channel.id, event_title, message_id))
+        for event in event_list:
+            try:
+                # the message is deleted right away, it is not edited first
+                event_message = await event.fetch_message(channel)
+                await bot.tobman.delete_message(event_message)
+            except discord.NotFound:
+                print(f'Message {event.message_id} not found, deleting event {event.title}', file=sys.stderr)
+            embed = discord.Embed(title = Translation.EVENTS_DELETE_TITLE,
                 type = 'rich',
-                description = Translation.EVENTS_LIST_DESC.format(channel.name, len(event_list))
+                description = Translation.EVENTS_DELETE_DESC.format(event.title)
             )
-            for event in event_list:
-                embed.add_field(name = event.title, value = event.summary())
-            await channel.send(embed = embed)
-            if bot.tobman.remove_event_commands:
-                await ctx.message.delete()
+            embed.add_field(name = Translation.EVENTS_DELETE_BY, value = author.mention)
+            bot.tobman.notifications.notify(channel, embed)
+        return event_list
+
+def no_event_embed(embed_title, description_format, channel, event_title):
+    embed = discord.Embed(title = embed_title,
+        type = 'rich',
+        description = description_format.format(event_title)
+    )
+    suggestions = bot.tobman.title_index.suggest(channel.guild.id, channel.id, event_title, limit = 5)
+    if suggestions:
+        embed.add_field(name = Translation.EVENTS_SUGGESTIONS, value = '\n'.join(event.title for event in suggestions))
+    return embed
 
 @bot.command(name='event.edit')
 async def event(ctx, event_title: str, *args):
     guild = ctx.guild
     author = ctx.author
     channel = ctx.message.channel
-    if (guild is not None) and (not author.bot) and Section.list_fits(bot.tobman.events_allowed_in, channel):
-        event_list = list(bot.tobman.get_events_by_title(guild.id, channel.id, event_title))
-        if event_list and len(event_list) > 0:
-            for event in event_list:
-                modifications = list(event.parse_edit_command(args))
-                error_count = 0
-                for modification, error in modifications:
-                    if error:
-                        if error == EventError.DATE_ERROR:
-                            error_embed = discord.Embed(title = Translation.EVENTS_NEW_ERROR, type = 'rich', description = Translation.EVENTS_NEW_ERROR_DATE_FORMAT.format(arg, Event.DATE_FORMAT))
-                            message = await channel.send(embed = error_embed)
-                        else:
-                            print(f'Error {error} while modifying event {event.title}, command: {args}', file=sys.stderr)
-                        error_count += 1
-                if (len(modifications) > 0) and (error_count == 0):
-                    bot.tobman.save_data()
-                    try:
-                        message = await event.refresh_message(channel)
-                        if message:
-                            new_embed = await event.generate_discord_embed()
-                            # Can't attach a file to a message edit...
-                            # ics_cal_file = discord.File(event.generate_date_ics(), filename = Translation.EVENT_CALENDAR_FILENAME.format(event.title))
-                            await message.edit(embed = new_embed)
-                    except discord.NotFound:
-                        print(f'Message {event.message_id} not found, modifying event {event.title}', file=sys.stderr)
-                    embed = discord.Embed(title = Translation.EVENTS_EDIT_TITLE,
-                        type = 'rich',
-                        description = Translation.EVENTS_EDIT_DESC.format(event.title, event.message_url())
-                    )
-                    embed.add_field(name = Translation.EVENTS_EDIT_BY, value = ctx.message.author.mention)
-                    await event.generate_add_ok_ng_embed_fields(embed)
-                    for modification, error in modifications:
-                        embed.add_field(name = Translation.EVENTS_MODIFICATION, value = str(modification))
-                    await channel.send(embed = embed)
-                if bot.tobman.remove_event_commands:
-                    await ctx.message.delete()
+    if (guild is not None) and (not author.bot) and bot.tobman.channel_allows(channel, SectionPermissions.EVENTS):
+        if len(await edit_events_by_title(channel, author, event_title, args)) > 0:
+            if bot.tobman.remove_event_commands:
+                await bot.tobman.delete_message(ctx.message)
         else:
-            embed = discord.Embed(title = Translation.EVENTS_EDIT_TITLE,
-                type = 'rich',
-                description = Translation.EVENTS_EDIT_NONE.format(event_title)
-            )
-            await channel.send(embed = embed)
+            await bot.tobman.send_message(channel, embed = no_event_embed(Translation.EVENTS_EDIT_TITLE, Translation.EVENTS_EDIT_NONE, channel, event_title))
 
 @bot.command(name='event.delete')
 async def event(ctx, event_title: str):
     guild = ctx.guild
     author = ctx.author
     channel = ctx.message.channel
-    if (guild is not None) and (not author.bot) and Section.list_fits(bot.tobman.events_allowed_in, channel):
-        event_list = list(bot.tobman.delete_events(guild.id, channel.id, event_title))
-        bot.tobman.save_data()
-        if event_list and len(event_list) > 0:
-            for event in event_list:
-                try:
-                    event_message = await event.refresh_message(channel)
-                    await event_message.delete()
-                except discord.NotFound:
-                    print(f'Message {event.message_id} not found, deleting event {event.title}', file=sys.stderr)
-                embed = discord.Embed(title = Translation.EVENTS_DELETE_TITLE,
-                    type = 'rich',
-                    description = Translation.EVENTS_DELETE_DESC.format(event.title)
-                )
-                embed.add_field(name = Translation.EVENTS_DELETE_BY, value = ctx.message.author.mention)
-                await channel.send(embed = embed)
+    if (guild is not None) and (not author.bot) and bot.tobman.channel_allows(channel, SectionPermissions.EVENTS):
+        if len(await delete_events_by_title(channel, author, event_title)) > 0:
             if bot.tobman.remove_event_commands:
-                await ctx.message.delete()
+                await bot.tobman.delete_message(ctx.message)
         else:
-            embed = discord.Embed(title = Translation.EVENTS_DELETE_TITLE,
-                type = 'rich',
-                description = Translation.EVENTS_DELETE_NONE.format(event_title)
-            )
-            await channel.send(embed = embed)
-        
+            await bot.tobman.send_message(channel, embed = no_event_embed(Translation.EVENTS_DELETE_TITLE, Translation.EVENTS_DELETE_NONE, channel, event_title))
+
+event_commands = app_commands.Group(name = 'event', description = 'Événements')
+
+async def event_title_autocomplete(interaction, current):
+    channel = interaction.channel
+    if (interaction.guild is None) or (not bot.tobman.channel_allows(channel, SectionPermissions.EVENTS)):
+        return []
+    choices = []
+    for suggested_event in bot.tobman.title_index.suggest(interaction.guild.id, channel.id, current):
+        # events sharing a title are each offered, told apart by their date
+        events = bot.tobman.title_index.find(interaction.guild.id, channel.id, suggested_event.title)
+        for event in events:
+            suffix = f' ({event.get_date_string()})' if (len(events) > 1) and event.date else ''
+            # choice names and values are limited to 100 characters, the value is the message id so that long titles still resolve
+            choices.append(app_commands.Choice(name = event.title[:100 - len(suffix)] + suffix, value = str(event.message_id)))
+    return choices[:TitleIndex.MAX_SUGGESTIONS]
+
+def autocompleted_message_id(channel, event_title):
+    # a picked suggestion sends the message id of the event, a typed value is a title
+    if event_title.isdigit() and bot.tobman.get_event(channel.guild.id, channel.id, int(event_title)):
+        return int(event_title)
+    return None
+
+@event_commands.command(name = 'edit', description = Translation.EVENTS_EDIT_COMMAND)
+@app_commands.autocomplete(event_title = event_title_autocomplete)
+async def event_edit_command(interaction, event_title: str, title: str = None, date: str = None, loc: str = None, url: str = None):
+    channel = interaction.channel
+    if (interaction.guild is None) or (not bot.tobman.channel_allows(channel, SectionPermissions.EVENTS)):
+        await interaction.response.send_message(Translation.EVENTS_EDIT_NONE.format(event_title), ephemeral = True)
+        return
+    message_id = autocompleted_message_id(channel, event_title)
+    args = [prefix + value for prefix, value in [(Event.TITLE_PREFIX, title), (Event.DATE_PREFIX, date), (Event.LOCATION_PREFIX, loc), (Event.URL_PREFIX, url)] if value is not None]
+    await interaction.response.defer(ephemeral = True)
+    edited_events = await edit_events_by_title(channel, interaction.user, event_title, args, message_id)
+    if edited_events:
+        embed = discord.Embed(title = Translation.EVENTS_EDIT_TITLE, type = 'rich',
+            description = '\n'.join(Translation.EVENTS_EDIT_DESC.format(event.title, event.message_url()) for event in edited_events))
+    else:
+        embed = no_event_embed(Translation.EVENTS_EDIT_TITLE, Translation.EVENTS_EDIT_NONE, channel, event_title)
+    await interaction.followup.send(embed = embed, ephemeral = True)
+
+@event_commands.command(name = 'delete', description = Translation.EVENTS_DELETE_COMMAND)
+@app_commands.autocomplete(event_title = event_title_autocomplete)
+async def event_delete_command(interaction, event_title: str):
+    channel = interaction.channel
+    if (interaction.guild is None) or (not bot.tobman.channel_allows(channel, SectionPermissions.EVENTS)):
+        await interaction.response.send_message(Translation.EVENTS_DELETE_NONE.format(event_title), ephemeral = True)
+        return
+    message_id = autocompleted_message_id(channel, event_title)
+    await interaction.response.defer(ephemeral = True)
+    deleted_events = await delete_events_by_title(channel, interaction.user, event_title, message_id)
+    if deleted_events:
+        embed = discord.Embed(title = Translation.EVENTS_DELETE_TITLE, type = 'rich',
+            description = '\n'.join(Translation.EVENTS_DELETE_DESC.format(event.title) for event in deleted_events))
+    else:
+        embed = no_event_embed(Translation.EVENTS_DELETE_TITLE, Translation.EVENTS_DELETE_NONE, channel, event_title)
+    await interaction.followup.send(embed = embed, ephemeral = True)
+
+bot.tree.add_command(event_commands)
+
 @bot.command(name='event.clear')
 async def event(ctx):
     guild = ctx.guild
     author = ctx.author
     channel = ctx.message.channel
-    if (guild is not None) and (not author.bot) and Section.list_fits(bot.tobman.events_allowed_in, channel):
-        event_list = bot.tobman.clear_events(guild.id, channel.id)
+    if (guild is not None) and (not author.bot) and bot.tobman.channel_allows(channel, SectionPermissions.EVENTS):
+        async with bot.tobman.channel_lock(guild.id, channel.id):
+            event_list = bot.tobman.clear_events(guild.id, channel.id)
         event_count = 0
         if event_list is not None:
             event_count = len(event_list)
@@ -812,20 +2717,63 @@ async def event(ctx):
             type = 'rich',
             description = Translation.EVENTS_CLEAR_DESC.format(event_count)
         )
-        await channel.send(embed = embed)
+        await bot.tobman.send_message(channel, embed = embed)
         if bot.tobman.remove_event_commands:
-            await ctx.message.delete()
+            await bot.tobman.delete_message(ctx.message)
 
 @bot.event
 async def on_raw_message_delete(raw_delete_event):
-    await bot.tobman.on_event_message_delete(raw_delete_event.guild_id, raw_delete_event.channel_id, raw_delete_event.message_id)
+    with bot.tobman.metrics.timer(Metrics.HANDLER_DURATION, handler = 'raw_message_delete'):
+        await bot.tobman.on_event_message_delete(raw_delete_event.guild_id, raw_delete_event.channel_id, raw_delete_event.message_id)
 
 @bot.event
 async def on_raw_reaction_add(raw_reaction_event):
-    await bot.tobman.on_event_reaction_add(raw_reaction_event.guild_id, raw_reaction_event.channel_id, raw_reaction_event.message_id, raw_reaction_event.user_id, raw_reaction_event.emoji)
+    with bot.tobman.metrics.timer(Metrics.HANDLER_DURATION, handler = 'raw_reaction_add'):
+        await bot.tobman.on_event_reaction_add(raw_reaction_event.guild_id, raw_reaction_event.channel_id, raw_reaction_event.message_id, raw_reaction_event.user_id, raw_reaction_event.emoji)
 
 @bot.event
 async def on_raw_reaction_remove(raw_reaction_event):
-    await bot.tobman.on_event_reaction_remove(raw_reaction_event.guild_id, raw_reaction_event.channel_id, raw_reaction_event.message_id, raw_reaction_event.user_id, raw_reaction_event.emoji)
+    with bot.tobman.metrics.timer(Metrics.HANDLER_DURATION, handler = 'raw_reaction_remove'):
+        await bot.tobman.on_event_reaction_remove(raw_reaction_event.guild_id, raw_reaction_event.channel_id, raw_reaction_event.message_id, raw_reaction_event.user_id, raw_reaction_event.emoji)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Tobman Discord bot')
+    parser.add_argument('--processes', type = int, default = 1, help = 'number of shard processes to start, sharing the SQLite event store')
+    parser.add_argument('--shard-count', type = int, help = 'total number of gateway shards')
+    parser.add_argument('--shard-ids', help = 'comma separated gateway shards run by this process')
+    parser.add_argument('--http-port', type = int, help = 'port of the HTTP server, instead of http_port of the configuration')
+    parser.add_argument('--fake-gateway', action = 'store_true', help = 'serve the stored guilds from an in-process fake gateway instead of Discord')
+    parser.add_argument('--convert-data', nargs = 2, metavar = ('SOURCE', 'DESTINATION'), help = 'convert event data between the JSON and snapshot formats (a .json destination is written as JSON) and exit')
+    args = parser.parse_args(argv)
+    if args.convert_data:
+        EventSnapshot.convert(*args.convert_data)
+        return 0
+    bot.tobman.load_config()
+    if args.processes > 1:
+        if not isinstance(bot.tobman.storage, SqliteEventStorage):
+            print(f'Error: several processes need data_storage: sqlite in {bot.tobman.config_filename}', file=sys.stderr)
+            return 1
+        # migrate the data once before the processes share the database
+        bot.tobman.load_data()
+        bot.tobman.storage.disconnect()
+        return launch_shard_processes(args.processes, args.shard_count or args.processes, args.fake_gateway, bot.tobman.web_server.port)
+    if args.http_port is not None:
+        bot.tobman.web_server.port = args.http_port
+    if args.shard_count is not None:
+        bot.shard_count = args.shard_count
+    if args.shard_ids is not None:
+        bot.shard_ids = [int(shard_id) for shard_id in args.shard_ids.split(',') if shard_id]
+    # the JSON and snapshot files hold every guild and are rewritten whole, processes running other shards would overwrite each other
+    if (getattr(bot, 'shard_ids', None) is not None) and (not isinstance(bot.tobman.storage, SqliteEventStorage)):
+        print(f'Error: shard_ids need data_storage: sqlite in {bot.tobman.config_filename}', file=sys.stderr)
+        return 1
+    bot.tobman.load_data()
+    if args.fake_gateway:
+        import fakediscord
+        asyncio.run(fakediscord.run_fake_gateway(bot))
+    else:
+        bot.run(bot.tobman.token)
+    return 0
 
-bot.run(bot.tobman.token)
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
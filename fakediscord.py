@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+# coding: utf-8
+from __future__ import annotations
+import discord
+import asyncio
+import collections
+import datetime
+import itertools
+import time
+
+class FakeResponse:
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+class FakeHTTP:
+    # (requests, per seconds) for each route, per channel like the Discord buckets
+    ROUTE_LIMITS = {
+        'fetch_message': (50, 1.0),
+        'edit_message': (5, 5.0),
+        'send_message': (5, 5.0),
+        'delete_message': (5, 1.0),
+        'add_reaction': (1, 0.25),
+        'reaction_users': (50, 1.0),
+        'history': (50, 1.0),
+    }
+    def __init__(self, latency = 0.0, route_limits = ROUTE_LIMITS):
+        self.latency = latency
+        self.route_limits = dict(route_limits)
+        self.buckets = {}
+        self.calls = collections.Counter()
+        self.rate_limit_waits = 0
+        self.rate_limit_wait_seconds = 0.0
+        self.on_request = None
+    async def request(self, route, major_id):
+        self.calls[route] += 1
+        if self.on_request is not None:
+            self.on_request(route)
+        limit = self.route_limits.get(route)
+        if limit is not None:
+            requests, per = limit
+            key = (route, major_id)
+            now = time.monotonic()
+            window_start, count = self.buckets.get(key, (now, 0))
+            if now - window_start >= per:
+                window_start, count = now, 0
+            if count >= requests:
+                # what discord.py does after a 429: wait for the bucket to reset, then retry
+                retry_after = window_start + per - now
+                self.rate_limit_waits += 1
+                self.rate_limit_wait_seconds += retry_after
+                await asyncio.sleep(retry_after)
+                window_start, count = time.monotonic(), 0
+            self.buckets[key] = (window_start, count + 1)
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+class FakePermissions:
+    def __init__(self):
+        self.send_messages = True
+        self.manage_messages = True
+        self.manage_nicknames = True
+        self.administrator = True
+
+class FakeUser:
+    def __init__(self, user_id, name, bot = False):
+        self.id = user_id
+        self.name = name
+        self.nick = None
+        self.bot = bot
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeMember(FakeUser):
+    def __init__(self, guild, user):
+        super().__init__(user.id, user.name, user.bot)
+        self.guild = guild
+        self.guild_permissions = FakePermissions()
+    async def edit(self, nick = None):
+        self.nick = nick
+
+class FakeReaction:
+    PAGE_SIZE = 100
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+        self.user_list = []
+    @property
+    def count(self):
+        return len(self.user_list)
+    @property
+    def me(self):
+        return self.message.channel.gateway.user in self.user_list
+    async def users(self):
+        user_list = list(self.user_list)
+        for page_start in range(0, max(len(user_list), 1), self.PAGE_SIZE):
+            await self.message.channel.gateway.http.request('reaction_users', self.message.channel.id)
+            for user in user_list[page_start:page_start + self.PAGE_SIZE]:
+                yield user
+
+class FakeAttachment:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+    async def read(self):
+        return self.data
+
+class FakeMessage:
+    def __init__(self, channel, message_id, content = None, embeds = None, attachments = None):
+        self.channel = channel
+        self.guild = channel.guild
+        self.id = message_id
+        self.content = content
+        self.embeds = list(embeds or [])
+        self.attachments = list(attachments or [])
+        self.reactions = []
+    def get_reaction(self, emoji):
+        for reaction in self.reactions:
+            if reaction.emoji == emoji:
+                return reaction
+        return None
+    def react(self, user, emoji):
+        reaction = self.get_reaction(emoji)
+        if reaction is None:
+            reaction = FakeReaction(self, emoji)
+            self.reactions.append(reaction)
+        if user not in reaction.user_list:
+            reaction.user_list.append(user)
+    def unreact(self, user, emoji):
+        reaction = self.get_reaction(emoji)
+        if (reaction is not None) and (user in reaction.user_list):
+            reaction.user_list.remove(user)
+            if reaction.count == 0:
+                self.reactions.remove(reaction)
+    async def add_reaction(self, emoji):
+        await self.channel.gateway.http.request('add_reaction', self.channel.id)
+        self.react(self.channel.gateway.user, emoji)
+    async def edit(self, embed = None, **kwargs):
+        await self.channel.gateway.http.request('edit_message', self.channel.id)
+        if embed is not None:
+            self.embeds = [embed]
+    async def delete(self):
+        await self.channel.gateway.http.request('delete_message', self.channel.id)
+        self.channel.messages.pop(self.id, None)
+
+class FakeCategoryChannel:
+    def __init__(self, guild, channel_id, name):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.channels = []
+
+class FakeTextChannel:
+    HISTORY_PAGE_SIZE = 100
+    def __init__(self, gateway, guild, channel_id, name, category = None):
+        self.gateway = gateway
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.category = category
+        self.messages = {}
+        self.sent = []
+    async def send(self, content = None, embed = None, embeds = None, file = None, view = None):
+        await self.gateway.http.request('send_message', self.id)
+        if embed is not None:
+            embeds = [embed]
+        message = FakeMessage(self, self.gateway.next_id(), content = content, embeds = embeds)
+        self.messages[message.id] = message
+        self.sent.append(message)
+        return message
+    async def fetch_message(self, message_id):
+        await self.gateway.http.request('fetch_message', self.id)
+        message = self.messages.get(message_id)
+        if message is None:
+            raise discord.NotFound(FakeResponse(404, 'Not Found'), 'Unknown Message')
+        return message
+    async def history(self, limit = 100, before = None, after = None, oldest_first = None):
+        message_ids = sorted(message_id for message_id in self.messages
+            if ((before is None) or (message_id < before.id)) and ((after is None) or (message_id > after.id)))
+        # like discord.py, the history is read from the oldest message when only after is given
+        if oldest_first is None:
+            oldest_first = (after is not None)
+        if not oldest_first:
+            message_ids.reverse()
+        if limit is not None:
+            message_ids = message_ids[:limit]
+        for page_start in range(0, max(len(message_ids), 1), self.HISTORY_PAGE_SIZE):
+            await self.gateway.http.request('history', self.id)
+            for message_id in message_ids[page_start:page_start + self.HISTORY_PAGE_SIZE]:
+                message = self.messages.get(message_id)
+                if message is not None:
+                    yield message
+    def permissions_for(self, member):
+        return FakePermissions()
+
+class FakeContext:
+    def __init__(self, channel, author, content = '', attachments = None):
+        self.guild = channel.guild
+        self.author = author
+        self.message = FakeMessage(channel, channel.gateway.next_id(), content = content, attachments = attachments)
+        self.message.author = author
+        channel.messages[self.message.id] = self.message
+
+class FakeGuild:
+    def __init__(self, gateway, guild_id, name):
+        self.gateway = gateway
+        self.id = guild_id
+        self.name = name
+        self.channels = {}
+        self.members = {}
+        self.me = self.add_member(gateway.user)
+    def __str__(self):
+        return self.name
+    def add_member(self, user):
+        member = self.members[user.id] = FakeMember(self, user)
+        return member
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+class FakeGateway:
+    def __init__(self, shard_count = None, shard_ids = None, latency = 0.0):
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+        self.http = FakeHTTP(latency)
+        self.ids = itertools.count(1 << 40)
+        self.user = FakeUser(self.next_id(), 'tobman', bot = True)
+        self.users = { self.user.id: self.user }
+        self.guilds = {}
+        self.channels = {}
+    def next_id(self):
+        return next(self.ids)
+    def guild_shard_id(guild_id, shard_count):
+        return (guild_id >> 22) % shard_count
+    def add_user(self, user_id = None, name = None):
+        user_id = user_id or self.next_id()
+        user = self.users[user_id] = FakeUser(user_id, name or f'user-{user_id}')
+        for guild in self.guilds.values():
+            guild.add_member(user)
+        return user
+    def add_guild(self, guild_id = None, name = None):
+        guild_id = guild_id or self.next_id()
+        guild = self.guilds[guild_id] = FakeGuild(self, guild_id, name or f'guild-{guild_id}')
+        for user in self.users.values():
+            guild.add_member(user)
+        return guild
+    def add_text_channel(self, guild, channel_id = None, name = None, category = None):
+        channel_id = channel_id or self.next_id()
+        channel = FakeTextChannel(self, guild, channel_id, name or f'channel-{channel_id}', category)
+        guild.channels[channel_id] = self.channels[channel_id] = channel
+        if category is not None:
+            category.channels.append(channel)
+        return channel
+    def add_category(self, guild, name, channel_id = None):
+        category = FakeCategoryChannel(guild, channel_id or self.next_id(), name)
+        guild.channels[category.id] = category
+        return category
+    def add_event_message(self, event):
+        channel = self.channels[event.channel_id]
+        message = channel.messages[event.message_id] = FakeMessage(channel, event.message_id)
+        for emoji, user_ids in [(event.REACTION_OK, event.ok_user_ids), (event.REACTION_NG, event.ng_user_ids)]:
+            message.react(self.user, emoji)
+            for user_id in sorted(user_ids or ()):
+                message.react(self.users.get(user_id) or self.add_user(user_id), emoji)
+        return message
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+    def shard_guilds(self):
+        if (self.shard_ids is None) or (not self.shard_count):
+            return list(self.guilds.values())
+        return [guild for guild in self.guilds.values() if FakeGateway.guild_shard_id(guild.id, self.shard_count) in self.shard_ids]
+    def install(self, bot):
+        bot.get_guild = self.get_guild
+        bot.get_channel = self.get_channel
+        bot.get_user = self.get_user
+        # the fake route names are the call names of Metrics.API_ROUTES
+        self.http.on_request = lambda route: bot.tobman.metrics.count_api_call(route)
+        # read by the Client.user property
+        bot._connection.user = self.user
+    async def connect(self, bot):
+        guilds = self.shard_guilds()
+        for guild in guilds:
+            await bot.on_guild_available(guild)
+        return guilds
+
+async def run_fake_gateway(bot):
+    tobman = bot.tobman
+    gateway = FakeGateway(bot.shard_count, bot.shard_ids)
+    for guild_id, channel_id in tobman.storage.stored_rooms():
+        guild = gateway.get_guild(guild_id) or gateway.add_guild(guild_id)
+        if gateway.get_channel(channel_id) is None:
+            gateway.add_text_channel(guild, channel_id)
+    gateway.install(bot)
+    await bot.setup_hook()
+    guilds = await gateway.connect(bot)
+    label = f'shards {bot.shard_ids} of {bot.shard_count}'
+    print(f'Fake gateway ({label}): {len(guilds)} guild(s), {len(tobman.events_by_message_id)} event(s) loaded')
+    for event in tobman.events_by_message_id.values():
+        gateway.add_event_message(event)
+    # run the reminders that are due today, as the scheduler would at SCHEDULE_TIME
+    reminder_days = [days_remaining for days_remaining, event_date_message in tobman.EVENT_DAYS]
+    due_reminders = [(event, event.remaining_days()) for event in tobman.events_by_message_id.values() if event.remaining_days() in reminder_days]
+    await tobman.events_scheduled_job(due_reminders)
+    await tobman.notifications.drain()
+    for channel in gateway.channels.values():
+        for message in channel.sent:
+            for embed in message.embeds:
+                print(f'Fake gateway ({label}): sent "{embed.title}" to channel {channel.id} of guild {channel.guild.id} at {datetime.datetime.now()}')
+    await tobman.shutdown()